@@ -1,7 +1,18 @@
-from os import getcwd, walk
-from os.path import ismount, getsize, isdir, isfile
+from os import (
+    getcwd, scandir, cpu_count, DirEntry, stat_result, read, close, strerror, fsencode, fsdecode, O_CLOEXEC, O_NONBLOCK,
+    statvfs, statvfs_result, stat, major, minor
+)
+from time import monotonic
+from select import select
+import ctypes
+from ctypes.util import find_library
+from errno import ENOENT
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from os.path import ismount, isdir, isfile, exists, realpath
 import subprocess
-from math import isnan
+import re
+from math import isnan, ceil
 import logging
 from sys import stdout, argv
 
@@ -232,6 +243,18 @@ class DiskMount:
             self.message: str = message
             super().__init__(self.message)
 
+    class DiskStats:
+        """All the numbers df shows for a partition, taken from a single statvfs() call. Sizes are in bytes."""
+
+        def __init__(self, path: str):
+            result: statvfs_result = statvfs(path)
+            self.size: int = result.f_blocks * result.f_frsize                    # df --output=size
+            self.used: int = (result.f_blocks - result.f_bfree) * result.f_frsize  # df --output=used
+            self.available: int = result.f_bavail * result.f_frsize               # df --output=avail
+            # df --output=pcent rounds up, and leaves the blocks reserved for root out of the total
+            self.usage: int = ceil(self.used * 100 / (self.used + self.available)) if self.used + self.available else 0
+            self.taken_at: float = monotonic()
+
     def __enter__(self):
         return self
 
@@ -239,30 +262,59 @@ class DiskMount:
         if self.is_mounted:
             self.unmount()
 
-    def __init__(self, uuid: str):
+    def __init__(self, uuid: str, stats_ttl: float = 0):
         self.uuid: str = uuid
         self.is_mounted: bool = False
         self.mount_point: None = None
+        self.stats_ttl: float = stats_ttl  # seconds that a stats() snapshot may be reused. 0 always takes a new one
+        self._stats: DiskMount.DiskStats | None = None
+        self.source: str = self.resolve_uuid(uuid)
+
+    @staticmethod
+    def resolve_uuid(uuid: str) -> str:
+        """Device path of a partition UUID, e.g. /dev/sdb1. udev keeps a symlink for every UUID in /dev/disk/by-uuid.
+        blkid is only run if that link is missing (no udev, or a UUID in upper case)."""
+        by_uuid: str = f'/dev/disk/by-uuid/{uuid}'
 
-        self.source: str = subprocess.run(
-            args=['blkid', '-o', 'value', '-U', self.uuid],
+        if exists(by_uuid):
+            return realpath(by_uuid)
+
+        return subprocess.run(
+            args=['blkid', '-o', 'value', '-U', uuid],
             text=True,
             capture_output=True,
             check=True
         ).stdout[:-1]
 
     def __repr__(self):
+        stats: DiskMount.DiskStats = self.stats()
         return f'''
              Drive: {self.source}
               UUID: {self.uuid}
            Mounted: {self.is_mounted}
         Mountpoint: {self.mount_point}
         
-         Disk Size: {byte_sizer(self.disk_size())}
-        Space Used: {byte_sizer(self.disk_used())}
-       Space Avail: {byte_sizer(self.disk_available())}
+         Disk Size: {byte_sizer(stats.size)}
+        Space Used: {byte_sizer(stats.used)}
+       Space Avail: {byte_sizer(stats.available)}
         '''
 
+    def stats(self) -> 'DiskMount.DiskStats':
+        """Size, used, available and usage of the partition from one statvfs() call. A snapshot younger than stats_ttl
+        seconds is reused. Call invalidate() after writing to the disk to force a fresh one."""
+        if self.is_mounted:
+            if self._stats is None or monotonic() - self._stats.taken_at >= self.stats_ttl:
+                self._stats = self.DiskStats(self.mount_point)
+            return self._stats
+        else:
+            raise self.DiskMountError(
+                message='Disk must be mounted before calling stats()'
+            )
+
+    def invalidate(self) -> None:
+        """Forget the cached stats() snapshot"""
+        self._stats = None
+
     def mount(self, mount_point:str , options:str | None=None):
         if ismount(mount_point):
             self.is_mounted: bool = False
@@ -283,6 +335,7 @@ class DiskMount:
             )
             self.is_mounted: bool = True
             self.mount_point: None | str = mount_point
+            self.invalidate()
 
             return proc_return
 
@@ -296,6 +349,7 @@ class DiskMount:
             )
             self.mount_point: None | str = None
             self.is_mounted: bool = False
+            self.invalidate()
             return proc_return
         else:
             raise self.DiskMountError(message='Disk is not mounted yet.')
@@ -303,15 +357,7 @@ class DiskMount:
     def disk_usage(self) -> int:
         """Percent used on disk partition"""
         if self.is_mounted:
-            df_percent_free: str = subprocess.run(
-                args=['df', self.source, '--output=pcent'],
-                text=True,
-                capture_output=True,
-                check=True
-            ).stdout
-
-            df_percent_free_int: int = int(df_percent_free.split()[-1][:-1])
-            return df_percent_free_int
+            return self.stats().usage
         else:
             raise self.DiskMountError(
                 message='Disk must be mounted before calling disk_usage()'
@@ -320,16 +366,7 @@ class DiskMount:
     def disk_size(self) -> int:
         """Total size of formatted space on disk partition"""
         if self.is_mounted:
-            df_total_size: str = subprocess.run(
-                args=['df', self.source, '--output=size'],
-                text=True,
-                capture_output=True,
-                check=True
-            ).stdout
-
-            df_total_size: int = int(df_total_size.split()[-1])
-            return df_total_size * 1024
-
+            return self.stats().size
         else:
             raise self.DiskMountError(
                 message='Disk must be mounted before calling disk_size().'
@@ -338,15 +375,7 @@ class DiskMount:
     def disk_available(self) -> int:
         """Show how much space is available on disk partition"""
         if self.is_mounted:
-            avail: str = subprocess.run(
-                args=['df', self.source, '--output=avail'],
-                text=True,
-                capture_output=True,
-                check=True
-            ).stdout
-
-            avail_int: int = int(avail.split()[-1])  # Gives back how many 1k block sizes
-            return avail_int * 1024
+            return self.stats().available
         else:
             raise self.DiskMountError(
                 message='Disk must be mounted before calling disk_available()'
@@ -355,15 +384,7 @@ class DiskMount:
     def disk_used(self) -> int:
         """Show how much space is used on disk partition"""
         if self.is_mounted:
-            used: str = subprocess.run(
-                args=['df', self.source, '--output=used'],
-                text=True,
-                capture_output=True,
-                check=True
-            ).stdout
-            
-            used_int: int = int(used.split()[-1])
-            return used_int * 1024
+            return self.stats().used
         else:
             raise self.DiskMountError(
                 message='Disk must be mounted before calling disk_used()'
@@ -371,19 +392,12 @@ class DiskMount:
 
     def find_mountpoint(self) -> str:
         """Checks to see if disk partition is already mounted"""
-        mount_point: None = None
-
-        mount_output: list[str] = subprocess.run(
-            args=['mount'],
-            capture_output=True,
-            text=True
-        ).stdout.split('\n')
+        try:
+            mount_point: str | None = self._mountpoint_from_mountinfo()
+        except OSError:
+            mount_point: str | None = self._mountpoint_from_mount()  # no /proc. Fall back on the mount command
 
-        for line in mount_output:
-            if self.source in line:
-                line_elements: list[str] = line.split()
-                mount_point: str = line_elements[2]
-                break
+        self.invalidate()
 
         if mount_point:
             self.mount_point: str = mount_point
@@ -396,6 +410,139 @@ class DiskMount:
                 message='Disk must be mounted before calling find_mountpoint().'
             )
 
+    def _mountpoint_from_mountinfo(self) -> str | None:
+        """Look the device up in /proc/self/mountinfo. A line is only a match when its mount source is exactly this
+        device, or when its device number is, so /dev/sdb1 can never match /dev/sdb10."""
+        device_number: str = ''
+        try:
+            rdev: int = stat(self.source).st_rdev
+            device_number: str = f'{major(rdev)}:{minor(rdev)}'
+        except OSError:
+            pass
+
+        with open('/proc/self/mountinfo', 'r') as fh:
+            for line in fh:
+                # 36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - ext3 /dev/root rw,errors=continue
+                fields, _, fs_fields = line.partition(' - ')
+                fields: list[str] = fields.split()
+                fs_fields: list[str] = fs_fields.split()
+                mount_source: str = _unescape_mount(fs_fields[1]) if len(fs_fields) > 1 else ''
+
+                if fields[2] == device_number:
+                    return _unescape_mount(fields[4])
+                if mount_source.startswith('/') and realpath(mount_source) == self.source:
+                    return _unescape_mount(fields[4])
+
+        return None
+
+    def _mountpoint_from_mount(self) -> str | None:
+        """The old way: parse the output of the mount command, matching the device exactly"""
+        mount_output: list[str] = subprocess.run(
+            args=['mount'],
+            capture_output=True,
+            text=True
+        ).stdout.split('\n')
+
+        for line in mount_output:
+            line_elements: list[str] = line.split()
+            if line_elements and line_elements[0] == self.source:
+                return line_elements[2]
+
+        return None
+
+
+def _unescape_mount(field: str) -> str:
+    """The kernel writes spaces, tabs, newlines and backslashes in mount paths as octal escapes like \\040"""
+    return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), field)
+
+
+class Inotify:
+    """
+    A small ctypes wrapper around the Linux inotify api, so that directories can be watched without any extra packages.
+
+    with Inotify() as inotify:
+        inotify.add_watch('/var/cache/zoneminder/events/1', Inotify.IN_CREATE | Inotify.IN_CLOSE_WRITE)
+        for wd, mask, cookie, name in inotify.read(timeout=5):
+            ...
+    """
+
+    # Event masks from <sys/inotify.h>
+    IN_MODIFY: int = 0x00000002
+    IN_CLOSE_WRITE: int = 0x00000008
+    IN_MOVED_FROM: int = 0x00000040
+    IN_MOVED_TO: int = 0x00000080
+    IN_CREATE: int = 0x00000100
+    IN_DELETE: int = 0x00000200
+    IN_DELETE_SELF: int = 0x00000400
+    IN_Q_OVERFLOW: int = 0x00004000
+    IN_IGNORED: int = 0x00008000
+    IN_ONLYDIR: int = 0x01000000
+    IN_ISDIR: int = 0x40000000
+
+    _event_header: struct.Struct = struct.Struct('iIII')  # wd, mask, cookie, len
+
+    class InotifyError(OSError):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __init__(self):
+        self._libc: ctypes.CDLL = ctypes.CDLL(find_library('c'), use_errno=True)
+        self.fd: int = self._libc.inotify_init1(O_CLOEXEC | O_NONBLOCK)
+
+        if self.fd < 0:
+            errno: int = ctypes.get_errno()
+            raise self.InotifyError(errno, strerror(errno))
+
+    def add_watch(self, path: str, mask: int) -> int:
+        """Watch path for the events in mask. Returns the watch descriptor that read() reports events with."""
+        wd: int = self._libc.inotify_add_watch(self.fd, fsencode(path), ctypes.c_uint32(mask))
+
+        if wd < 0:
+            errno: int = ctypes.get_errno()
+
+            if errno == ENOENT:
+                raise FileNotFoundError(errno, strerror(errno), path)  # removed before it could be watched
+
+            raise self.InotifyError(errno, strerror(errno), path)
+
+        return wd
+
+    def rm_watch(self, wd: int) -> None:
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout: float | None = None) -> list[tuple[int, int, int, str]]:
+        """Wait up to timeout seconds for events. Returns a list of (wd, mask, cookie, name)."""
+        readable, _, _ = select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            buffer: bytes = read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events: list[tuple[int, int, int, str]] = []
+        offset: int = 0
+
+        while offset < len(buffer):
+            wd, mask, cookie, length = self._event_header.unpack_from(buffer, offset)
+            offset += self._event_header.size
+            name: str = fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, cookie, name))
+
+        return events
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            close(self.fd)
+            self.fd = -1
+
 
 def byte_sizer(file_size: int | float, round_digit: int=2) -> str:
     """Get a human-readable string based on very large integers representing the size of a file or directory. Numbers
@@ -459,21 +606,87 @@ def byte_sizer(file_size: int | float, round_digit: int=2) -> str:
     return f'{sign}{byte_size} {byte_type}'  # human-readable size like "3.4 Gb"
 
 
-def get_dir_size(path: str) -> int:
+def get_dir_size(path: str, apparent: bool = True, workers: int | None = None) -> int:
     """Crawl through a directory and get the size of everything it contains. This will return a very large integer which
-    can be turned into a human-readable string using the function above."""
+    can be turned into a human-readable string using the function above. See get_dir_sizes() for the arguments."""
 
-    if isdir(path):
-        size_counter: int = 0
+    return sum(get_dir_sizes(path, depth=1, apparent=apparent, workers=workers).values())
 
-        for root, dirs, files in walk(path):
-            for file in files:
-                size_counter += getsize(f'{root}/{file}')
 
-        return size_counter
-    else:
+def get_dir_sizes(path: str, depth: int = 1, apparent: bool = True, workers: int | None = None,
+                  follow_symlinks: bool = False) -> dict[str, int]:
+    """Size every subdirectory that is `depth` levels below path in a single pass. Returns a dict keyed by the
+    subdirectory path relative to path, e.g. depth=2 on the ZoneMinder events dir gives {'camera/2024-01-31': 123, ...}.
+    Files that sit above that depth are counted under '.'.
+
+    Each subdirectory is crawled on its own thread with os.scandir(), which gets file types from the directory listing
+    and only needs one stat() per file. apparent=True counts file sizes like `du --apparent-size`, apparent=False counts
+    the blocks actually allocated on disk like `du`. follow_symlinks only applies to the levels above depth (like the
+    camera links in the events dir). Links inside the subdirectories are never followed."""
+
+    if not isdir(path):
         raise NotADirectoryError
 
+    sizes: dict[str, int] = {'.': 0}
+    subdirs: list[tuple[str, str]] = []  # (relative path, full path)
+    level: list[tuple[str, str]] = [('', path)]
+
+    # Walk down to the requested depth. Everything below that depth is one job for the pool
+    for _ in range(depth):
+        next_level: list[tuple[str, str]] = []
+
+        for rel_path, full_path in level:
+            with scandir(full_path) as entries:
+                for entry in entries:
+                    entry_rel_path: str = f'{rel_path}/{entry.name}' if rel_path else entry.name
+
+                    if entry.is_dir(follow_symlinks=follow_symlinks):
+                        next_level.append((entry_rel_path, entry.path))
+                    else:
+                        sizes['.'] += _entry_size(entry, apparent)
+
+        level = next_level
+
+    subdirs.extend(level)
+
+    with ThreadPoolExecutor(max_workers=workers or min(32, (cpu_count() or 1) * 4)) as pool:
+        # Crawling is mostly waiting on the disk, so more threads than cores pays off
+        totals = pool.map(lambda subdir: _tree_size(subdir[1], apparent), subdirs)
+
+        for (rel_path, _), total in zip(subdirs, totals):
+            sizes[rel_path] = total
+
+    return sizes
+
+
+def _entry_size(entry: DirEntry, apparent: bool) -> int:
+    """Size of one directory entry. Uses the stat result that scandir() caches on the entry."""
+    try:
+        entry_stat: stat_result = entry.stat(follow_symlinks=False)
+    except FileNotFoundError:
+        return 0  # removed since the directory was listed
+
+    return entry_stat.st_size if apparent else entry_stat.st_blocks * 512
+
+
+def _tree_size(path: str, apparent: bool) -> int:
+    """Total size of every file below path, crawled with scandir() and without recursion"""
+    size_counter: int = 0
+    stack: list[str] = [path]
+
+    while stack:
+        try:
+            with scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        size_counter += _entry_size(entry, apparent)
+        except FileNotFoundError:
+            continue  # removed while we were crawling (ZoneMinder purges events on its own)
+
+    return size_counter
+
 
 def rsync(src: str, dest: str, args: str='-ar') -> subprocess.CompletedProcess[str]:
     """A simple python wrapper for rsync"""
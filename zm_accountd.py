@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+# Long-running storage accounting daemon. Watches the camera caches with inotify, keeps the size of every recent
+# camera/date directory in memory, and writes the ones that changed to camera_sizes every few seconds. Other scripts
+# can then read up-to-date sizes (today's directory included) without crawling the events tree.
+#
+# Only the last accountd_watch_days date directories of each camera are watched, since ZoneMinder only writes to those.
+# Older directories are left to zm_collect.py.
+import signal
+import sqlite3
+from os import scandir, stat
+from os.path import realpath, relpath
+from time import monotonic
+from datetime import datetime as dt, timedelta as td
+from admintools import MyLogger, Inotify
+from zm_db import connect, ensure_schema, update_sizes
+from zm_lib import zm_dir, camera_caches, db_file, db_log_file, date_fmt, accountd_flush_seconds, accountd_watch_days
+
+
+logger = MyLogger(
+    name='zm_accountd',
+    level=20,
+    to_console=True,
+    to_file=db_log_file
+).logger
+
+camera_mask: int = Inotify.IN_CREATE | Inotify.IN_MOVED_TO | Inotify.IN_ONLYDIR
+date_mask: int = Inotify.IN_CREATE | Inotify.IN_MOVED_TO | Inotify.IN_DELETE | Inotify.IN_MOVED_FROM
+event_mask: int = Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO | Inotify.IN_DELETE | Inotify.IN_MOVED_FROM
+
+
+class StorageAccountant:
+    """
+    In-memory byte counters per (cache, date), fed by inotify events and flushed to the database in batches. The size
+    of every file is kept as well, so a file that is written again (or was already counted when the directory was
+    sized) only changes the total by the difference.
+    """
+
+    def __init__(self, inotify: Inotify):
+        self.inotify: Inotify = inotify
+        self.watches: dict[int, tuple[str, str | None, str | None]] = {}  # wd: (cache, date, event)
+        self.sizes: dict[tuple[str, str], int] = {}  # (cache, date): bytes
+        self.files: dict[tuple[str, str], dict[str, int]] = {}  # (cache, date): {path in the date directory: bytes}
+        self.dirty: set[tuple[str, str]] = set()     # changed since the last flush
+        self.stale: set[tuple[str, str]] = set()     # lost track (files deleted, queue overflow). Re-size on flush
+        self.cache_paths: dict[str, str] = {}        # cache: where its symlink points to
+
+    def watch_cache(self, cache: str) -> None:
+        """Watch a camera directory for new date directories, and the recent date directories already in it"""
+        cache_path: str = realpath(f'{zm_dir}/{cache}')
+        self.cache_paths[cache] = cache_path
+        self.watches[self.inotify.add_watch(cache_path, camera_mask)] = (cache, None, None)
+
+        with scandir(cache_path) as entries:
+            for entry in entries:
+                if entry.is_dir() and self._is_date(entry.name) and entry.name >= self._oldest_date():
+                    try:
+                        self.watch_date(cache, entry.name, entry.path)
+                    except FileNotFoundError:
+                        continue  # purged by ZoneMinder while we looked
+
+    def watch_date(self, cache: str, date: str, date_path: str) -> None:
+        """Watch a date directory and every event directory in it. Its size is taken once here as a starting point."""
+        self.watches[self.inotify.add_watch(date_path, date_mask)] = (cache, date, None)
+
+        with scandir(date_path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    try:
+                        self.watches[self.inotify.add_watch(entry.path, event_mask)] = (cache, date, entry.name)
+                    except FileNotFoundError:
+                        continue  # purged by ZoneMinder while we looked
+
+        # Sized after the watches are in place, so nothing written in between is missed
+        self.files[(cache, date)] = {}
+        self.sizes[(cache, date)] = 0
+        self.scan(cache, date, date_path)
+
+    def watch_event(self, cache: str, date: str, event_path: str) -> None:
+        """Watch a new event directory. Frames written before the watch was added are counted right away."""
+        event: str = event_path.rsplit('/', 1)[-1]
+        self.watches[self.inotify.add_watch(event_path, event_mask)] = (cache, date, event)
+        self.scan(cache, date, event_path)
+
+    def scan(self, cache: str, date: str, path: str) -> None:
+        """Record the size of every file below path, a date directory or one of its event directories"""
+        date_path: str = self._date_path(cache, date)
+        stack: list[str] = [path]
+
+        while stack:
+            try:
+                with scandir(stack.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            self.set_file(cache, date, relpath(entry.path, date_path),
+                                          entry.stat(follow_symlinks=False).st_size)
+            except FileNotFoundError:
+                continue  # purged by ZoneMinder while we looked
+
+    def set_file(self, cache: str, date: str, name: str, size: int) -> None:
+        """A file in a date directory has size bytes now. Only the difference to what it had is added."""
+        files: dict[str, int] = self.files.setdefault((cache, date), {})
+        self.sizes[(cache, date)] = self.sizes.get((cache, date), 0) + size - files.get(name, 0)
+        files[name] = size
+        self.dirty.add((cache, date))
+
+    def drop_file(self, cache: str, date: str, name: str) -> None:
+        """A file in a date directory is gone"""
+        size: int = self.files.get((cache, date), {}).pop(name, 0)
+        self.sizes[(cache, date)] = self.sizes.get((cache, date), 0) - size
+        self.dirty.add((cache, date))
+
+    def handle(self, wd: int, mask: int, name: str) -> None:
+        if mask & Inotify.IN_Q_OVERFLOW:
+            logger.warning('inotify queue overflowed. Re-sizing every watched directory on the next flush.')
+            self.stale.update(self.sizes)
+            return
+
+        if mask & Inotify.IN_IGNORED:
+            self.watches.pop(wd, None)  # the watched directory is gone
+            return
+
+        if wd not in self.watches:
+            return
+
+        cache, date, event = self.watches[wd]
+        is_dir: bool = bool(mask & Inotify.IN_ISDIR)
+        created: bool = bool(mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO | Inotify.IN_CLOSE_WRITE))
+
+        try:
+            if date is None:
+                # A new date directory in a camera directory
+                if is_dir and created and self._is_date(name):
+                    self.watch_date(cache, name, self._date_path(cache, name))
+            elif event is None:
+                # A new or removed event directory in a date directory
+                if is_dir and created:
+                    self.watch_event(cache, date, f'{self._date_path(cache, date)}/{name}')
+                elif not created:
+                    self.stale.add((cache, date))
+            elif mask & (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO) and not is_dir:
+                # A finished (or rewritten) frame or video file
+                self.set_file(cache, date, f'{event}/{name}',
+                              stat(f'{self._date_path(cache, date)}/{event}/{name}').st_size)
+            elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM) and not is_dir:
+                self.drop_file(cache, date, f'{event}/{name}')
+            elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                self.stale.add((cache, date))
+        except FileNotFoundError:
+            if date is not None:
+                self.stale.add((cache, date))  # removed before we got to it. A date directory is simply not watched
+
+    def prune(self) -> None:
+        """Stop watching date directories that have aged out of accountd_watch_days"""
+        oldest: str = self._oldest_date()
+
+        for wd, (cache, date, _) in list(self.watches.items()):
+            if date is not None and date < oldest:
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+                self.sizes.pop((cache, date), None)
+                self.files.pop((cache, date), None)
+
+    def flush(self, con: sqlite3.Connection) -> int:
+        """Write every changed size to camera_sizes in one transaction. Returns how many rows were written."""
+        for cache, date in self.stale:
+            self.files[(cache, date)] = {}
+            self.sizes[(cache, date)] = 0
+
+            try:
+                stat(self._date_path(cache, date))
+            except FileNotFoundError:
+                self.sizes.pop((cache, date), None)  # the whole day was archived or deleted. Keep the last size
+                self.files.pop((cache, date), None)
+                self.dirty.discard((cache, date))
+                continue
+
+            self.scan(cache, date, self._date_path(cache, date))
+            self.dirty.add((cache, date))
+
+        self.stale.clear()
+
+        if not self.dirty:
+            return 0
+
+        with con:
+            update_sizes(con, {key: self.sizes[key] for key in self.dirty if key in self.sizes})
+
+        num_rows: int = len(self.dirty)
+        self.dirty.clear()
+        return num_rows
+
+    def _date_path(self, cache: str, date: str) -> str:
+        return f'{self.cache_paths[cache]}/{date}'
+
+    @staticmethod
+    def _oldest_date() -> str:
+        return dt.strftime(dt.now() - td(days=accountd_watch_days), date_fmt)
+
+    @staticmethod
+    def _is_date(name: str) -> bool:
+        try:
+            dt.strptime(name, date_fmt)
+            return True
+        except ValueError:
+            return False
+
+
+running: bool = True
+
+
+def stop(signum, frame) -> None:
+    global running
+    running = False
+
+
+signal.signal(signal.SIGTERM, stop)
+signal.signal(signal.SIGINT, stop)
+
+con: sqlite3.Connection = connect(db_file)
+ensure_schema(con, camera_caches)
+
+with Inotify() as inotify:
+    accountant: StorageAccountant = StorageAccountant(inotify)
+
+    for cache in camera_caches:
+        accountant.watch_cache(cache)
+
+    logger.warning(f'Watching {len(accountant.watches)} directories in {len(camera_caches)} caches')
+    next_flush: float = monotonic() + accountd_flush_seconds
+
+    while running:
+        # Wake up at least once a second so a stop signal is handled quickly
+        for wd, mask, _, name in inotify.read(timeout=min(1.0, max(0.0, next_flush - monotonic()))):
+            accountant.handle(wd, mask, name)
+
+        if monotonic() >= next_flush:
+            logger.debug(f'Flushed {accountant.flush(con)} sizes to {db_file}')
+            accountant.prune()
+            next_flush = monotonic() + accountd_flush_seconds
+
+    accountant.flush(con)
+
+con.close()
+logger.warning('Done\n\n')
@@ -0,0 +1,581 @@
+import io
+import bz2
+import json
+import hashlib
+import lzma
+import zlib
+import random
+import tarfile
+from glob import glob, escape
+from os import cpu_count, makedirs, replace, remove, scandir, sep
+from os.path import join, isfile, splitext, dirname
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock
+from typing import Callable, BinaryIO
+from admintools import get_dir_sizes
+from zm_throttle import Throttle
+from zm_manifest import (
+    HashingTarFile, manifest_path, write_manifest, read_manifest, file_digest, stream_digests, compare_digests,
+    segment_reader, flush_to_disk, sync_directory
+)
+
+try:
+    import zstandard  # optional. Only needed for the zstd codec.  $ pip install zstandard
+except ImportError:
+    zstandard = None
+
+
+class ArchiveError(Exception):
+    def __init__(self, message='Archive failed'):
+        self.message: str = message
+        super().__init__(self.message)
+
+
+# What reading a damaged, torn or unsupported archive (or its index or manifest) can raise
+archive_errors: tuple[type[Exception], ...] = (
+    ArchiveError, OSError, EOFError, ValueError, KeyError, tarfile.TarError, lzma.LZMAError
+) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+class Codec:
+    """
+    A block compressor. Every block is compressed as its own complete stream, and the streams are written back to back.
+    bzip2, xz and zstd all decompress concatenated streams as one file, so the output works with the normal tar/bzip2/
+    xz/zstd tools. This is the same trick used by pbzip2 and pixz.
+    """
+
+    def __init__(self, name: str, extension: str, block_size: int, level: int,
+                 compress: Callable[[bytes, int], bytes], reader: Callable[[BinaryIO], BinaryIO]):
+        self.name: str = name
+        self.extension: str = extension    # file extension, without the leading dot
+        self.block_size: int = block_size  # bytes of tar stream per independently compressed block
+        self.level: int = level            # default compression level
+        self._compress: Callable[[bytes, int], bytes] = compress
+        self.reader: Callable[[BinaryIO], BinaryIO] = reader  # wraps a compressed file in a decompressing one
+
+    def __repr__(self):
+        return f'Codec({self.name}, .{self.extension})'
+
+    def compress(self, data: bytes, level: int | None = None) -> bytes:
+        return self._compress(data, self.level if level is None else level)
+
+
+def _zstd_compress(data: bytes, level: int) -> bytes:
+    if zstandard is None:
+        raise ArchiveError('The zstd codec needs the zstandard package. $ pip install zstandard')
+
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _zstd_reader(fileobj: BinaryIO) -> BinaryIO:
+    if zstandard is None:
+        raise ArchiveError('The zstd codec needs the zstandard package. $ pip install zstandard')
+
+    return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+
+
+codecs: dict[str, Codec] = {
+    # store only. For footage that is already compressed (jpeg frames, h264)
+    'tar': Codec('tar', 'tar', 4 * 1024 ** 2, 0, lambda data, level: data, lambda fh: fh),
+    # bzip2 works in 900k blocks internally, so anything a few times larger loses nothing to the split
+    'bzip2': Codec('bzip2', 'tar.bz2', 8 * 1024 ** 2, 9, lambda data, level: bz2.compress(data, level),
+                   bz2.BZ2File),
+    # xz needs big blocks to make use of its dictionary (8 MiB at the default preset)
+    'xz': Codec('xz', 'tar.xz', 24 * 1024 ** 2, 6, lambda data, level: lzma.compress(data, preset=level),
+                lzma.LZMAFile),
+    'zstd': Codec('zstd', 'tar.zst', 16 * 1024 ** 2, 3, _zstd_compress, _zstd_reader),
+}
+
+# shutil.make_archive() format names still work
+codec_aliases: dict[str, str] = {
+    'bztar': 'bzip2',
+    'bz2': 'bzip2',
+    'xztar': 'xz',
+    'zstdtar': 'zstd',
+    'zst': 'zstd',
+}
+
+# Used by choose_codec(). Ratios are compressed size / original size, as estimated by estimate_ratio()
+store_ratio: float = 0.97  # saves less than 3%: not worth any cpu
+heavy_ratio: float = 0.6   # saves more than 40%: worth the slow codecs
+
+# One pool is shared by every archive job so that several jobs running at once do not oversubscribe the cpu.
+# bz2, lzma and zstandard all release the GIL while compressing, so threads are enough to use every core.
+_pool: ThreadPoolExecutor | None = None
+_pool_lock: Lock = Lock()
+
+
+def get_codec(name: str) -> Codec:
+    """Look up a codec by name or by its shutil.make_archive() format name"""
+    try:
+        return codecs[codec_aliases.get(name, name)]
+    except KeyError:
+        raise ArchiveError(f'Unknown compression type {name}. Choose from {", ".join(available_codecs())}')
+
+
+def available_codecs() -> list[str]:
+    """Codecs that can be used on this system"""
+    return [name for name in codecs if name != 'zstd' or zstandard is not None]
+
+
+def get_pool(workers: int | None = None) -> ThreadPoolExecutor:
+    """The shared compression pool. It is created on first use with one thread per core."""
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=workers or cpu_count() or 1,
+                thread_name_prefix='zm_compress'
+            )
+
+    return _pool
+
+
+class BlockWriter:
+    """
+    A write-only file object that cuts everything written to it into blocks, compresses the blocks in parallel on the
+    shared pool, and writes the compressed blocks to the output file in their original order. Only a bounded number of
+    blocks are held in memory at once. With a throttle every write waits its turn, which paces the reading of the files
+    that are being archived.
+    """
+
+    def __init__(self, fileobj: BinaryIO, codec: Codec, level: int | None = None, workers: int | None = None,
+                 throttle: Throttle | None = None):
+        self.fileobj: BinaryIO = fileobj
+        self.throttle: Throttle | None = throttle
+        self.codec: Codec = codec
+        self.level: int | None = level
+        self.pool: ThreadPoolExecutor = get_pool(workers)
+        self.max_pending: int = 2 * (workers or cpu_count() or 1)  # blocks in flight before write() waits
+        self.pending: deque[Future] = deque()
+        self.buffer: bytearray = bytearray()
+        self.bytes_in: int = 0   # uncompressed bytes written by the caller
+        self.bytes_out: int = 0  # compressed bytes written to the output file
+        self.blocks: int = 0     # blocks submitted so far
+        self.offsets: list[int] = []  # where each block starts in the output file, once it has been written
+        self.hash = hashlib.sha256()  # of the output file, taken as it is written
+
+    def tell(self) -> int:
+        """Position in the uncompressed stream. tarfile asks for it."""
+        return self.bytes_in
+
+    def write(self, data: bytes) -> int:
+        with self.throttle.io(len(data)) if self.throttle else nullcontext():
+            self.buffer += data
+            self.bytes_in += len(data)
+
+            while len(self.buffer) >= self.codec.block_size:
+                block: bytes = bytes(self.buffer[:self.codec.block_size])
+                del self.buffer[:self.codec.block_size]
+                self._submit(block)
+
+        return len(data)
+
+    def flush_block(self) -> None:
+        """Compress whatever is buffered as a (short) block of its own"""
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+
+    def close(self) -> None:
+        self.flush_block()
+
+        while self.pending:
+            self._drain_one()
+
+    def _submit(self, block: bytes) -> None:
+        while len(self.pending) >= self.max_pending:
+            self._drain_one()
+
+        self.pending.append(self.pool.submit(self.codec.compress, block, self.level))
+        self.blocks += 1
+
+    def _drain_one(self) -> None:
+        compressed: bytes = self.pending.popleft().result()
+        self.offsets.append(self.bytes_out)
+        self.fileobj.write(compressed)
+        self.hash.update(compressed)
+        self.bytes_out += len(compressed)
+
+
+def estimate_ratio(path: str, sample_files: int = 32, sample_bytes: int = 256 * 1024) -> tuple[float, dict[str, float]]:
+    """
+    Estimate how well a directory compresses without compressing all of it. The files are grouped by extension, the
+    first sample_bytes of up to sample_files random files of each group are compressed with zlib -1, and the ratios of
+    the groups are weighted by their share of the bytes. Returns (ratio, {extension: ratio}).
+    """
+    rng: random.Random = random.Random(0)
+    sizes: dict[str, int] = {}       # extension: bytes
+    counts: dict[str, int] = {}      # extension: files
+    samples: dict[str, list[str]] = {}
+    stack: list[str] = [path]
+
+    while stack:
+        with scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                elif not entry.is_file(follow_symlinks=False):
+                    continue
+
+                extension: str = splitext(entry.name)[1].lower()
+                sizes[extension] = sizes.get(extension, 0) + entry.stat(follow_symlinks=False).st_size
+                counts[extension] = counts.get(extension, 0) + 1
+                reservoir: list[str] = samples.setdefault(extension, [])
+
+                # reservoir sampling, so the sample is spread over the whole day without listing every file first
+                if len(reservoir) < sample_files:
+                    reservoir.append(entry.path)
+                else:
+                    slot: int = rng.randrange(counts[extension])
+                    if slot < sample_files:
+                        reservoir[slot] = entry.path
+
+    ratios: dict[str, float] = {}
+
+    for extension, paths in samples.items():
+        original: int = 0
+        compressed: int = 0
+
+        for sample_path in paths:
+            try:
+                with open(sample_path, 'rb') as fh:
+                    data: bytes = fh.read(sample_bytes)
+            except FileNotFoundError:
+                continue
+            original += len(data)
+            compressed += len(zlib.compress(data, 1))
+
+        ratios[extension] = compressed / original if original else 1.0
+
+    total: int = sum(sizes.values())
+
+    if not total:
+        return 1.0, ratios
+
+    return sum(ratios[extension] * size for extension, size in sizes.items()) / total, ratios
+
+
+def choose_codec(ratio: float, heavy: str = 'bzip2') -> tuple[str, int | None]:
+    """
+    Pick a codec and level for an estimated ratio. Footage that does not compress is stored, footage that compresses a
+    little gets a fast codec (zstd, or xz -1 without the zstandard package), and only footage that compresses well
+    gets the heavy codec.
+    """
+    if ratio >= store_ratio:
+        return 'tar', None
+    elif ratio >= heavy_ratio:
+        return ('zstd', None) if zstandard is not None else ('xz', 1)
+
+    return heavy, None
+
+
+def make_archive(base_name: str, root_dir: str, base_dir: str, compression_type: str = 'bzip2',
+                 level: int | None = None, workers: int | None = None, throttle: Throttle | None = None,
+                 index: bool = False, manifest: bool = False, members: list[str] | None = None) -> str:
+    """
+    A drop-in for shutil.make_archive() that compresses a single directory on every core. The archive is written to a
+    .part file first and renamed once it is complete, so a half written archive never looks finished. Returns the path
+    of the finished archive.
+
+    With index=True every event directory (every directory directly in base_dir) starts a new compressed block, and
+    where each event lives in the archive is written to a sidecar index (see index_path()). One event can then be
+    restored by seeking to it and decompressing only its own blocks. The archive itself is still a normal tar file.
+
+    With manifest=True the sha256 of every file is taken while tarfile reads it, and the sha256 of the archive while it
+    is written, and both go into a manifest next to the archive (see verify_archive()). Nothing is read twice.
+
+    members limits the archive to those entries of base_dir (by name), for one part of a multi-volume archive set. See
+    plan_parts().
+    """
+    codec: Codec = get_codec(compression_type)
+    archive_path: str = f'{base_name}.{codec.extension}'
+    part_path: str = f'{archive_path}.part'
+    index_part_path: str = f'{index_path(archive_path)}.part'
+    tar_class: type[tarfile.TarFile] = HashingTarFile if manifest else tarfile.TarFile
+
+    try:
+        with open(part_path, 'wb') as fh:
+            writer: BlockWriter = BlockWriter(fh, codec, level=level, workers=workers, throttle=throttle)
+
+            with tar_class.open(fileobj=writer, mode='w') as tar:
+                if index:
+                    events: dict[str, dict] = _add_events(tar, writer, join(root_dir, base_dir), base_dir, members)
+                elif members is None:
+                    tar.add(join(root_dir, base_dir), arcname=base_dir)
+                else:
+                    tar.add(join(root_dir, base_dir), arcname=base_dir, recursive=False)
+                    for name in members:
+                        tar.add(join(root_dir, base_dir, name), arcname=join(base_dir, name))
+
+            writer.close()
+            flush_to_disk(fh)  # on the disk before the rename says it is finished
+
+        if index:
+            writer.offsets.append(writer.bytes_out)  # the end of the last block
+
+            for entry in events.values():
+                first_block, last_block = entry.pop('blocks')
+                entry['offset'] = writer.offsets[first_block]
+                entry['length'] = writer.offsets[last_block] - entry['offset']
+
+            with open(index_part_path, 'w') as fh:
+                json.dump({
+                    'archive': archive_path.rsplit('/', 1)[-1],
+                    'codec': codec.name,
+                    'root': base_dir.replace(sep, '/').strip('/'),
+                    'events': events,
+                }, fh)
+                flush_to_disk(fh)
+
+        if manifest:
+            write_manifest(manifest_path(archive_path), {
+                'archive': archive_path.rsplit('/', 1)[-1],
+                'codec': codec.name,
+                'archive_bytes': writer.bytes_out,
+                'archive_sha256': writer.hash.hexdigest(),
+                'files': tar.digests,
+            })
+    except BaseException:
+        for path in (part_path, index_part_path):
+            if isfile(path):
+                remove(path)
+        raise
+
+    replace(part_path, archive_path)
+
+    if index:
+        replace(index_part_path, index_path(archive_path))
+
+    sync_directory(dirname(archive_path) or '.')
+
+    return archive_path
+
+
+def _add_events(tar: tarfile.TarFile, writer: BlockWriter, source: str, arcname: str,
+                members: list[str] | None = None) -> dict[str, dict]:
+    """
+    Add a day directory to the archive one event directory at a time, each in blocks of its own. Files that are not in
+    an event directory go in first, as the event '.'. Only the entries named in members are added, if given. Returns
+    {event: entry} for the index, where the entry still has the (first, last) block numbers instead of offsets.
+    """
+    with scandir(source) as entries:
+        children: list = sorted(
+            (entry for entry in entries if members is None or entry.name in members), key=lambda entry: entry.name
+        )
+
+    groups: list[tuple[str, list[tuple[str, str, bool]]]] = [
+        ('.', [(source, arcname, False)] + [
+            (child.path, join(arcname, child.name), False)
+            for child in children if not child.is_dir(follow_symlinks=False)
+        ])
+    ] + [
+        (child.name, [(child.path, join(arcname, child.name), True)])
+        for child in children if child.is_dir(follow_symlinks=False)
+    ]
+
+    events: dict[str, dict] = {}
+
+    for event, members in groups:
+        writer.flush_block()
+        first_block: int = writer.blocks
+        mtimes: list[int] = []
+
+        def track(member: tarfile.TarInfo) -> tarfile.TarInfo:
+            if member.isfile():
+                mtimes.append(member.mtime)
+            return member
+
+        for path, name, recursive in members:
+            tar.add(path, arcname=name, recursive=recursive, filter=track)
+
+        writer.flush_block()
+        events[event] = {
+            'blocks': (first_block, writer.blocks),
+            'files': len(mtimes),
+            'first': min(mtimes, default=None),  # mtime range of the frames/videos in the event
+            'last': max(mtimes, default=None),
+        }
+
+    return events
+
+
+def plan_parts(path: str, part_size: int) -> list[tuple[list[str], int]]:
+    """
+    Split a day directory into parts of about part_size bytes, to be archived at once as a multi-volume archive set.
+    Event directories are never split, and go in event id order, so each part holds a run of consecutive events. Files
+    that are not in an event go in the first part. Returns [(names of the entries in the part, bytes)].
+    """
+    sizes: dict[str, int] = get_dir_sizes(path, depth=1)
+
+    with scandir(path) as entries:
+        loose: list[str] = [entry.name for entry in entries if not entry.is_dir(follow_symlinks=False)]
+
+    parts: list[tuple[list[str], int]] = [(loose, sizes.pop('.'))]
+
+    for event in sorted(sizes, key=lambda name: (len(name), name)):  # numeric order for numeric event ids
+        names, size = parts[-1]
+
+        if names and size + sizes[event] > part_size:
+            parts.append(([event], sizes[event]))
+        else:
+            names.append(event)
+            parts[-1] = (names, size + sizes[event])
+
+    return parts
+
+
+def part_base_name(base_name: str, number: int) -> str:
+    """base_name of one part of a multi-volume archive set, e.g. 2024-05-01_cam.part002 for 2024-05-01_cam"""
+    return f'{base_name}.part{number:03}'
+
+
+def archive_parts(base_name: str) -> list[str]:
+    """The parts of a multi-volume archive set that are on disk, in order. Unfinished .part files are left out."""
+    extensions: tuple[str, ...] = tuple(f'.{codec.extension}' for codec in codecs.values())
+    return sorted(path for path in glob(f'{escape(base_name)}.part[0-9][0-9][0-9].*') if path.endswith(extensions))
+
+
+def day_archives(base_name: str) -> list[str]:
+    """Every archive of a camera-day that is on disk: whole archives in any codec, and parts"""
+    return [
+        f'{base_name}.{codec.extension}' for codec in codecs.values() if isfile(f'{base_name}.{codec.extension}')
+    ] + archive_parts(base_name)
+
+
+def remove_archive(archive_path: str) -> None:
+    """Delete an archive together with its index and manifest"""
+    for path in (archive_path, index_path(archive_path), manifest_path(archive_path)):
+        if isfile(path):
+            remove(path)
+
+
+def index_path(archive_path: str) -> str:
+    return f'{archive_path}.index.json'
+
+
+def read_index(archive_path: str) -> dict:
+    """The sidecar index of an archive made with index=True. Raises ArchiveError if there is none."""
+    try:
+        with open(index_path(archive_path), 'r') as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        raise ArchiveError(f'{archive_path} has no index. It was made before indexing or with index=False.')
+
+
+def verify_archive(archive_path: str, deep: bool = True, workers: int | None = None,
+                   uncached: bool = False) -> list[str]:
+    """
+    Check an archive against its manifest. The archive is read back and its sha256 compared. With deep=True it is also
+    decompressed and the sha256 of every file compared, which proves the archive holds exactly what was archived.
+    Indexed archives are decompressed one event per core. uncached=True drops the archive from the page cache first,
+    so a file that was just written is read back from the disk. Returns the problems; an empty list means all is well.
+    """
+    try:
+        archive_manifest: dict = read_manifest(manifest_path(archive_path))
+    except FileNotFoundError:
+        return [f'{archive_path} has no manifest']
+
+    if file_digest(archive_path, uncached) != (archive_manifest['archive_bytes'], archive_manifest['archive_sha256']):
+        return [f'{archive_path}: the archive does not match its manifest']
+
+    if not deep:
+        return []
+
+    codec: Codec = get_codec(archive_manifest['codec'])
+
+    def segment_digests(offset: int, length: int) -> dict[str, tuple[int, str]]:
+        with open(archive_path, 'rb') as fh:
+            fh.seek(offset)
+            return stream_digests(codec.reader(segment_reader(fh, length)))
+
+    segments: list[tuple[int, int]] = [(0, archive_manifest['archive_bytes'])]
+
+    if isfile(index_path(archive_path)):
+        segments = [(entry['offset'], entry['length']) for entry in read_index(archive_path)['events'].values()]
+
+    found: dict[str, tuple[int, str]] = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for digests in pool.map(lambda segment: segment_digests(*segment), segments):
+            found.update(digests)
+
+    return compare_digests(archive_manifest['files'], found, archive_path)
+
+
+def codec_for(archive_path: str) -> Codec:
+    """The codec of an archive, from its file extension"""
+    for codec in sorted(codecs.values(), key=lambda codec: -len(codec.extension)):
+        if archive_path.endswith(f'.{codec.extension}'):
+            return codec
+
+    raise ArchiveError(f'{archive_path} is not a tar, tar.bz2, tar.xz or tar.zst archive')
+
+
+def extract_event(archive_path: str, event: str, destination: str, archive_index: dict | None = None,
+                  throttle: Throttle | None = None, keep_owner: bool = False) -> int:
+    """
+    Extract one event of an indexed archive into destination, by seeking straight to its blocks. Paths are made
+    relative to the archived day directory, so the event ends up in destination/event. keep_owner restores the owner
+    and group of every file (when running as root), for footage that goes back where ZoneMinder has to manage it.
+    Returns the number of files.
+    """
+    archive_index = archive_index or read_index(archive_path)
+
+    try:
+        entry: dict = archive_index['events'][event]
+    except KeyError:
+        raise ArchiveError(f'Event {event} is not in {archive_path}')
+
+    with open(archive_path, 'rb') as fh:
+        fh.seek(entry['offset'])
+        segment: io.BufferedReader = segment_reader(fh, entry['length'])
+
+        # The segment is a piece of a tar stream that ends right after the event. tarfile stops there cleanly.
+        return _extract_stream(get_codec(archive_index['codec']).reader(segment), destination,
+                               f"{archive_index['root']}/", throttle, keep_owner)
+
+
+def extract_archive(archive_path: str, destination: str, throttle: Throttle | None = None,
+                    keep_owner: bool = False) -> int:
+    """
+    Extract a whole archive into destination as it is read, without a temporary copy. Paths are made relative to the
+    archived day directory, which works for archives with and without an index. keep_owner is as for extract_event().
+    Returns the number of files.
+    """
+    with open(archive_path, 'rb') as fh:
+        return _extract_stream(codec_for(archive_path).reader(io.BufferedReader(fh, 1024 ** 2)), destination, None,
+                               throttle, keep_owner)
+
+
+def _extract_stream(fileobj: BinaryIO, destination: str, prefix: str | None, throttle: Throttle | None,
+                    keep_owner: bool = False) -> int:
+    """
+    Extract a tar stream, with every member name made relative to prefix. Without a prefix the first member (the day
+    directory, since a directory is always added before its contents) is the prefix. The 'tar' filter keeps owners and
+    modes and the 'data' filter drops them; both refuse paths that would end up outside destination.
+    """
+    extract_filter: str = 'tar' if keep_owner else 'data'
+    num_files: int = 0
+    makedirs(destination, exist_ok=True)  # events and parts of one day are extracted side by side. tarfile would race
+
+    with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+        for member in tar:
+            if prefix is None:
+                prefix = f'{member.name.rstrip("/")}/'
+
+            if not member.name.startswith(prefix):
+                continue  # the day directory itself
+
+            member.name = member.name[len(prefix):]
+
+            with throttle.io(member.size) if throttle else nullcontext():
+                tar.extract(member, destination, filter=extract_filter)
+
+            num_files += member.isreg()
+
+    return num_files
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+# Fill the camera_sizes table with the size of every camera/date directory on the system. A fingerprint of every
+# date directory is kept in the zm_fingerprints table, and only directories whose fingerprint changed since the last
+# run are crawled again. On a normal night that is just today's directory.
+import sqlite3
+from os import scandir, stat
+from datetime import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from admintools import MyLogger, get_dir_size, byte_sizer
+from zm_db import connect, ensure_schema, update_sizes
+from zm_lib import zm_dir, camera_caches, db_file, db_log_file, date_fmt
+
+
+logger = MyLogger(
+    name='zm_collect',
+    level=20,
+    to_console=True,
+    to_file=db_log_file
+).logger
+
+
+def fingerprint(date_path: str) -> tuple[float, int, int]:
+    """
+    Cheap change detection for a date directory without crawling it. ZoneMinder writes frames into event directories,
+    which bumps the mtime of the event directory but not of the date directory, so the newest mtime of the date
+    directory and its event directories is used along with the number of entries. A video that is appended to changes
+    neither, so the bytes in the newest event directory (the one still being recorded) are counted as well. Returns
+    (mtime, inodes, bytes in the newest event).
+    """
+    newest: float = stat(date_path).st_mtime
+    newest_event: str | None = None
+    inodes: int = 0
+
+    with scandir(date_path) as entries:
+        for entry in entries:
+            inodes += 1
+            try:
+                mtime: float = entry.stat(follow_symlinks=False).st_mtime
+            except FileNotFoundError:
+                continue
+
+            if mtime >= newest and entry.is_dir(follow_symlinks=False):
+                newest_event = entry.path
+            newest = max(newest, mtime)
+
+    return newest, inodes, _files_size(newest_event) if newest_event else 0
+
+
+def _files_size(path: str) -> int:
+    """Bytes in the files directly in a directory"""
+    size: int = 0
+
+    try:
+        with scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file(follow_symlinks=False):
+                        size += entry.stat(follow_symlinks=False).st_size
+                except FileNotFoundError:
+                    continue
+    except FileNotFoundError:
+        pass  # purged by ZoneMinder while we looked
+
+    return size
+
+
+def day_size(cache: str, date: str) -> int | None:
+    """Size of a date directory, or None if it was archived or deleted since it was fingerprinted"""
+    try:
+        return get_dir_size(f'{zm_dir}/{cache}/{date}')
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+start: dt = dt.now()
+con: sqlite3.Connection = connect(db_file)
+con.execute('''
+    create table if not exists zm_fingerprints (
+        cache text,
+        date text,
+        mtime real,
+        inodes integer,
+        size integer,
+        primary key (cache, date)
+    )
+''')
+if 'newest_bytes' not in [column[1] for column in con.execute('pragma table_info(zm_fingerprints)')]:
+    con.execute('alter table zm_fingerprints add column newest_bytes integer')  # tables made before it was added
+ensure_schema(con, camera_caches)
+
+known: dict[tuple[str, str], tuple[float, int, int]] = {
+    (cache, date): (mtime, inodes, newest_bytes)
+    for cache, date, mtime, inodes, newest_bytes in con.execute(
+        'select cache, date, mtime, inodes, newest_bytes from zm_fingerprints'
+    )
+}
+
+changed: dict[tuple[str, str], tuple[float, int, int]] = {}  # (cache, date): fingerprint
+num_dirs: int = 0
+
+for cache in camera_caches:
+    with scandir(f'{zm_dir}/{cache}') as entries:
+        for entry in entries:
+            try:
+                dt.strptime(entry.name, date_fmt)
+            except ValueError:
+                logger.warning(f'Invalid date folder found {entry.path}. Skipping.')
+                continue
+
+            try:
+                new_fingerprint: tuple[float, int, int] = fingerprint(entry.path)
+            except FileNotFoundError:
+                continue  # archived or deleted by zm_move.py while we looked
+
+            num_dirs += 1
+
+            if known.get((cache, entry.name)) != new_fingerprint:
+                changed[(cache, entry.name)] = new_fingerprint
+
+logger.info(f'{len(changed)} of {num_dirs} date directories changed since the last run')
+
+with ThreadPoolExecutor(max_workers=4) as pool:
+    # get_dir_size() already crawls each directory on several threads. A few at a time keeps both disks busy.
+    keys: list[tuple[str, str]] = list(changed)
+    sizes: dict[tuple[str, str], int] = {
+        key: size for key, size in zip(keys, pool.map(lambda key: day_size(*key), keys)) if size is not None
+    }
+
+with con:
+    update_sizes(con, sizes)
+    con.executemany(
+        '''insert or replace into zm_fingerprints (cache, date, mtime, inodes, newest_bytes, size)
+           values (?, ?, ?, ?, ?, ?)''',
+        [(cache, date, *changed[(cache, date)], size) for (cache, date), size in sizes.items()]
+    )
+
+con.close()
+
+logger.info(f'Collected {byte_sizer(sum(sizes.values()))} from {len(sizes)} directories in {dt.now() - start}')
+logger.warning('Done\n\n')
@@ -0,0 +1,425 @@
+import sqlite3
+import pandas as pd
+from admintools import get_dir_size
+
+
+def connect(db_file: str) -> sqlite3.Connection:
+    """Open the zm_size database in WAL mode, so readers are never blocked by a writer"""
+    con: sqlite3.Connection = sqlite3.connect(db_file)
+    con.execute('pragma journal_mode=wal')
+    return con
+
+
+def quote(name: str) -> str:
+    """Quote a table or column name. Camera names become column names in the zm_sizes view."""
+    escaped: str = name.replace('"', '""')
+    return f'"{escaped}"'
+
+
+def literal(value: str) -> str:
+    """Quote a string value for sql that cannot use parameters, like a view definition"""
+    escaped: str = value.replace("'", "''")
+    return f"'{escaped}'"
+
+
+def table_columns(con: sqlite3.Connection, table: str) -> list[str]:
+    """Column names of a table, or an empty list if it does not exist"""
+    return [row[1] for row in con.execute(f'pragma table_info({quote(table)})')]
+
+
+def ensure_columns(con: sqlite3.Connection, table: str, columns: list[str], column_type: str = '') -> None:
+    """Add any of columns that table does not have yet"""
+    existing: list[str] = table_columns(con, table)
+
+    for column in columns:
+        if column not in existing:
+            con.execute(f'alter table {quote(table)} add column {quote(column)} {column_type}')
+
+
+def ensure_unique_key(con: sqlite3.Connection, table: str, key: list[str]) -> None:
+    """
+    Put a unique index on the key columns so that rows can be upserted with "on conflict". Tables written by
+    DataFrame.to_sql() have no index at all and may hold duplicate keys. Only the newest copy of those is kept.
+    """
+    index_name: str = quote(f'{table}_{"_".join(key)}_key')
+    key_columns: str = ', '.join(quote(column) for column in key)
+
+    try:
+        con.execute(f'create unique index if not exists {index_name} on {quote(table)} ({key_columns})')
+    except sqlite3.IntegrityError:
+        con.execute(f'''
+            delete from {quote(table)} where rowid not in (
+                select max(rowid) from {quote(table)} group by {key_columns}
+            )
+        ''')
+        con.execute(f'create unique index if not exists {index_name} on {quote(table)} ({key_columns})')
+
+
+def table_type(con: sqlite3.Connection, name: str) -> str | None:
+    """'table', 'view', or None if there is nothing by that name"""
+    row: tuple | None = con.execute('select type from sqlite_master where name = ?', (name,)).fetchone()
+    return row[0] if row else None
+
+
+def ensure_schema(con: sqlite3.Connection, caches: list[str]) -> None:
+    """
+    Create the camera_sizes table if needed. An old wide zm_sizes table is migrated into it, and zm_sizes is
+    (re)created as a view in the old wide layout for the scripts that read it.
+    """
+    create_schema(con)
+
+    if table_type(con, 'zm_sizes') == 'table':
+        migrate_wide_table(con)
+
+    create_compat_view(con, caches)
+
+
+def create_schema(con: sqlite3.Connection) -> None:
+    """Create the camera_sizes table (one row per camera per date) and its indexes"""
+    con.execute('''
+        create table if not exists camera_sizes (
+            date text not null,
+            camera text not null,
+            bytes integer,
+            status text,
+            location text,
+            primary key (camera, date)
+        )
+    ''')
+    # (camera, date) lookups and ranges use the primary key. These cover per-date and per-status queries.
+    con.execute('create unique index if not exists camera_sizes_date_camera_key on camera_sizes (date, camera)')
+    con.execute('create index if not exists camera_sizes_status on camera_sizes (status, camera, date)')
+    create_rollups(con)
+    create_codec_table(con)
+
+
+def create_rollups(con: sqlite3.Connection) -> None:
+    """
+    Create the camera_rollups table: bytes and number of days per camera and status for every month ('month', 'YYYY-MM')
+    and year ('year', 'YYYY'). Triggers on camera_sizes keep it up to date as rows are inserted, updated or deleted,
+    so reports read a handful of rows instead of adding up the whole history. It is filled from camera_sizes the first
+    time it is created.
+    """
+    if table_type(con, 'camera_rollups'):
+        return
+
+    with con:
+        con.execute('''
+            create table camera_rollups (
+                span text not null,
+                period text not null,
+                camera text not null,
+                status text not null,
+                bytes integer not null default 0,
+                days integer not null default 0,
+                primary key (span, period, camera, status)
+            )
+        ''')
+
+        for span, length in _rollup_spans:
+            con.execute(f'''
+                insert into camera_rollups (span, period, camera, status, bytes, days)
+                select '{span}', substr(date, 1, {length}), camera, coalesce(status, 'unknown'),
+                       coalesce(sum(bytes), 0), count(*)
+                from camera_sizes
+                group by substr(date, 1, {length}), camera, coalesce(status, 'unknown')
+            ''')
+
+        con.execute(f'''
+            create trigger camera_rollups_insert after insert on camera_sizes
+            begin
+                {_rollup_change('new', 1)}
+            end
+        ''')
+        con.execute(f'''
+            create trigger camera_rollups_delete after delete on camera_sizes
+            begin
+                {_rollup_change('old', -1)}
+            end
+        ''')
+        con.execute(f'''
+            create trigger camera_rollups_update after update of date, camera, bytes, status on camera_sizes
+            begin
+                {_rollup_change('old', -1)}
+                {_rollup_change('new', 1)}
+            end
+        ''')
+
+
+_rollup_spans: list[tuple[str, int]] = [('month', 7), ('year', 4)]  # (span, length of the date prefix)
+
+
+def _rollup_change(row: str, sign: int) -> str:
+    """Trigger statements that add (sign=1) or take away (sign=-1) a camera_sizes row from every rollup it is in"""
+    return ''.join(
+        f'''
+        insert into camera_rollups (span, period, camera, status, bytes, days)
+        values ('{span}', substr({row}.date, 1, {length}), {row}.camera, coalesce({row}.status, 'unknown'),
+                {sign} * coalesce({row}.bytes, 0), {sign})
+        on conflict (span, period, camera, status) do update set
+            bytes = bytes + excluded.bytes,
+            days = days + excluded.days;
+        {_rollup_prune(row, span, length) if sign < 0 else ''}
+        '''
+        for span, length in _rollup_spans
+    )
+
+
+def _rollup_prune(row: str, span: str, length: int) -> str:
+    """Trigger statement that drops a rollup row once the last day in it is gone"""
+    return f'''
+        delete from camera_rollups
+        where span = '{span}' and period = substr({row}.date, 1, {length}) and camera = {row}.camera
+              and status = coalesce({row}.status, 'unknown') and days = 0;
+    '''
+
+
+def migrate_wide_table(con: sqlite3.Connection) -> int:
+    """
+    Copy the old wide zm_sizes table (a date column plus one column per camera) into camera_sizes, then rename it to
+    zm_sizes_wide so the compatibility view can take its name. Per-camera status columns written by zm_db_paths.py
+    (<camera>_status) are carried over. Returns the number of rows copied.
+    """
+    columns: list[str] = table_columns(con, 'zm_sizes')
+    status_columns: set[str] = {column for column in columns if column.endswith('_status')}
+    cameras: list[str] = [
+        column for column in columns
+        if column not in ('date', 'status', 'path') and column not in status_columns
+    ]
+    num_rows: int = 0
+
+    with con:
+        for camera in cameras:
+            camera_status: str = quote(f'{camera}_status') if f'{camera}_status' in status_columns else 'null'
+            day_status: str = 'status' if 'status' in columns else 'null'
+            day_path: str = 'path' if 'path' in columns else 'null'
+
+            # Days where a camera has no size did not have that camera yet
+            num_rows += con.execute(f'''
+                insert or ignore into camera_sizes (date, camera, bytes, status, location)
+                select
+                    date,
+                    ?,
+                    {quote(camera)},
+                    coalesce({camera_status}, nullif({day_status}, 'split')),
+                    case when coalesce({camera_status}, {day_status}) = {day_status} then {day_path} end
+                from zm_sizes
+                where {quote(camera)} is not null
+            ''', (camera,)).rowcount
+
+        con.execute('alter table zm_sizes rename to zm_sizes_wide')
+
+    return num_rows
+
+
+def create_compat_view(con: sqlite3.Connection, caches: list[str]) -> None:
+    """
+    (Re)create zm_sizes as a view over camera_sizes with the old wide layout: date, one size column and one
+    <camera>_status column per camera, and the day-level status and path. It only has to be rebuilt when a camera is
+    added.
+    """
+    cameras: list[str] = sorted(
+        set(caches) | {row[0] for row in con.execute('select distinct camera from camera_sizes')}
+    )
+    view_columns: list[str] = table_columns(con, 'zm_sizes')
+
+    if view_columns and all(camera in view_columns for camera in cameras):
+        return
+
+    size_columns: str = ''.join(
+        f'max(case when camera = {literal(camera)} then bytes end) as {quote(camera)},\n'
+        for camera in cameras
+    )
+    status_columns: str = ''.join(
+        f'max(case when camera = {literal(camera)} then status end) as {quote(f"{camera}_status")},\n'
+        for camera in cameras
+    )
+
+    with con:
+        con.execute('drop view if exists zm_sizes')
+        con.execute(f'''
+            create view zm_sizes as
+            select
+                date,
+                {size_columns}
+                {status_columns}
+                case
+                    when sum(status = 'on_system') > 0 and sum(status = 'on_backup') > 0 then 'split'
+                    when sum(status = 'on_system') > 0 then 'on_system'
+                    when sum(status = 'on_backup') > 0 then 'on_backup'
+                    when count(status) > 0 then 'deleted'
+                end as status,
+                case when count(distinct location) = 1 then max(location) end as path
+            from camera_sizes
+            group by date
+        ''')
+
+
+def update_sizes(con: sqlite3.Connection, sizes: dict[tuple[str, str], int]) -> None:
+    """Write sizes keyed by (cache, date) into camera_sizes, adding rows that are missing"""
+    con.executemany(
+        '''
+        insert into camera_sizes (date, camera, bytes) values (?, ?, ?)
+        on conflict (camera, date) do update set bytes = excluded.bytes
+        ''',
+        [(date, cache, size) for (cache, date), size in sizes.items()]
+    )
+
+
+def set_status(con: sqlite3.Connection, camera_dates: list[tuple[str, str]], status: str, location: str | None) -> None:
+    """Set the status and location of some (camera, date) rows of camera_sizes, adding rows that are missing"""
+    con.executemany(
+        '''
+        insert into camera_sizes (date, camera, status, location) values (?, ?, ?, ?)
+        on conflict (camera, date) do update set status = excluded.status, location = excluded.location
+        ''',
+        [(date, camera, status, location) for camera, date in camera_dates]
+    )
+
+
+def create_codec_table(con: sqlite3.Connection) -> None:
+    """
+    Create the archive_codecs table: the codec picked for every archived camera/date and how well it did. sampled_ratio
+    is the estimate the choice was based on, or null if the choice of an earlier sample was reused.
+    """
+    con.execute('''
+        create table if not exists archive_codecs (
+            camera text not null,
+            date text not null,
+            codec text not null,
+            level integer,
+            sampled_ratio real,
+            sampled_on text,
+            bytes_in integer,
+            bytes_out integer,
+            primary key (camera, date)
+        )
+    ''')
+
+
+def last_codec_sample(con: sqlite3.Connection, camera: str, since: str) -> tuple[str, int | None, float] | None:
+    """The codec, level and sampled ratio of the newest sample of a camera taken on or after since (YYYY-MM-DD)"""
+    return con.execute(
+        '''
+        select codec, level, sampled_ratio from archive_codecs
+        where camera = ? and sampled_ratio is not null and sampled_on >= ?
+        order by sampled_on desc, date desc limit 1
+        ''',
+        (camera, since)
+    ).fetchone()
+
+
+def record_codec_choice(con: sqlite3.Connection, camera: str, date: str, codec: str, level: int | None,
+                        sampled_ratio: float | None, sampled_on: str | None, bytes_in: int, bytes_out: int) -> None:
+    con.execute(
+        '''
+        insert or replace into archive_codecs
+            (camera, date, codec, level, sampled_ratio, sampled_on, bytes_in, bytes_out)
+        values (?, ?, ?, ?, ?, ?, ?, ?)
+        ''',
+        (camera, date, codec, level, sampled_ratio, sampled_on, bytes_in, bytes_out)
+    )
+
+
+def save_changes(con: sqlite3.Connection, table: str, old: pd.DataFrame, new: pd.DataFrame,
+                 key: list[str]) -> tuple[int, int]:
+    """
+    Persist new without rewriting the whole table. Rows are matched to old on the key columns, and only the rows that
+    differ are written: an update for rows that changed and an "insert ... on conflict" for rows that are new. Columns
+    that the table does not have yet are added. Everything happens in one transaction.
+
+    Rows that are in old but not in new are left alone. Returns (rows updated, rows inserted).
+    """
+    columns: list[str] = [column for column in new.columns if column not in key]
+    new_indexed: pd.DataFrame = new.set_index(key)
+    old_indexed: pd.DataFrame = old.set_index(key).reindex(columns=columns)
+
+    existing: pd.Index = new_indexed.index.intersection(old_indexed.index)
+    new_existing: pd.DataFrame = new_indexed.loc[existing, columns]
+    old_existing: pd.DataFrame = old_indexed.loc[existing, columns]
+
+    # A value is unchanged if it is equal, or if it is missing on both sides
+    unchanged: pd.DataFrame = (new_existing == old_existing) | (new_existing.isna() & old_existing.isna())
+    changed: pd.DataFrame = new_existing[~unchanged.all(axis=1)]
+    added: pd.DataFrame = new_indexed.loc[new_indexed.index.difference(old_indexed.index), columns]
+
+    set_clause: str = ', '.join(f'{quote(column)} = ?' for column in columns)
+    where_clause: str = ' and '.join(f'{quote(column)} = ?' for column in key)
+    insert_columns: str = ', '.join(quote(column) for column in key + columns)
+    placeholders: str = ', '.join('?' for _ in key + columns)
+    excluded: str = ', '.join(f'{quote(column)} = excluded.{quote(column)}' for column in columns)
+    key_columns: str = ', '.join(quote(column) for column in key)
+
+    with con:
+        ensure_columns(con, table, columns)
+        ensure_unique_key(con, table, key)
+
+        if columns and len(changed):
+            con.executemany(
+                f'update {quote(table)} set {set_clause} where {where_clause}',
+                [(*values, *row_key) for row_key, values in _rows(changed)]
+            )
+
+        if len(added):
+            con.executemany(
+                f'''
+                insert into {quote(table)} ({insert_columns}) values ({placeholders})
+                on conflict ({key_columns}) do {f'update set {excluded}' if columns else 'nothing'}
+                ''',
+                [(*row_key, *values) for row_key, values in _rows(added)]
+            )
+
+    return len(changed), len(added)
+
+
+def _rows(frame: pd.DataFrame) -> list[tuple[tuple, list]]:
+    """(key tuple, values) for every row, with numpy types turned into python types and NaN into None"""
+    values: pd.DataFrame = frame.astype(object).where(frame.notna(), None)
+    keys: list = values.index.tolist()
+
+    return [
+        (row_key if isinstance(row_key, tuple) else (row_key,), row)
+        for row_key, row in zip(keys, values.values.tolist())
+    ]
+
+
+class SizeIndex:
+    """
+    In-memory (cache, date): bytes lookup for scheduling. Only the cameras and dates that are asked for are read from
+    camera_sizes, through its (camera, date) primary key. A (cache, date) that has no size in the database is sized
+    from disk instead, so a missing row never stops a job from being scheduled.
+    """
+
+    def __init__(self, con: sqlite3.Connection, caches: list[str], before: str | None = None):
+        self.sizes: dict[tuple[str, str], int] = {}
+        self.misses: int = 0  # lookups that had to be sized from disk
+        self.load(con, caches, before)
+
+    def load(self, con: sqlite3.Connection, caches: list[str], before: str | None = None) -> None:
+        """Read the sizes of caches for every date older than before (YYYY-MM-DD), or every date if before is None"""
+        caches: list[str] = list(dict.fromkeys(caches))
+        query: str = f'''
+            select camera, date, bytes from camera_sizes
+            where camera in ({", ".join("?" for _ in caches)}) and bytes is not null
+        '''
+        params: list[str] = caches
+
+        if before is not None:
+            query += ' and date < ?'
+            params: list[str] = caches + [before]
+
+        for cache, date, size in con.execute(query, params):
+            self.sizes[(cache, date)] = int(size)
+
+    def get(self, cache: str, date: str, path: str | None = None) -> int:
+        """Size of a camera/date directory. Falls back to sizing path on disk when the database does not know it."""
+        try:
+            return self.sizes[(cache, date)]
+        except KeyError:
+            if path is None:
+                raise
+
+        self.misses += 1
+        size: int = get_dir_size(path)
+        self.sizes[(cache, date)] = size
+        return size
@@ -1,8 +1,10 @@
 #!/nfs_share/matt_desktop/server_scripts/zm_helper/venv_nfs/bin/python3.11
+import numpy as np
 import pandas as pd
 import sqlite3
-from os.path import isdir
+from os import scandir
 from admintools import DiskMount, MyLogger
+from zm_db import connect, ensure_schema, save_changes
 from zm_lib import disk_uuid, mount_point, zm_dir, camera_caches, db_file, db_log_file
 
 
@@ -14,14 +16,30 @@ logger = MyLogger(
 ).logger
 
 
-con: sqlite3.Connection = sqlite3.connect(db_file)
-df: pd.DataFrame = pd.read_sql('select * from zm_sizes', con)
+con: sqlite3.Connection = connect(db_file)
+ensure_schema(con, camera_caches)
+# What is in the db now. Used to find changes
+df_saved: pd.DataFrame = pd.read_sql('select date, camera, status, location from camera_sizes', con)
+df: pd.DataFrame = df_saved.copy()
 
 
 save_to_db: bool = True
 allow_unmount: bool = False
-df['status']: None | str = None
-df['path']: None | str = None
+
+
+def present_dirs(root: str, caches: list[str]) -> set[tuple[str, str]]:
+    """One scandir() pass over a cache root. Returns every (cache, date) directory that exists under it."""
+    present: set[tuple[str, str]] = set()
+
+    for cache in caches:
+        try:
+            with scandir(f'{root}/{cache}') as entries:
+                present.update((cache, entry.name) for entry in entries if entry.is_dir())
+        except FileNotFoundError:
+            continue  # this camera has nothing on this disk
+
+    return present
+
 
 zm_backup_vol: DiskMount = DiskMount(uuid=disk_uuid)
 
@@ -37,43 +55,26 @@ except DiskMount.DiskMountError:
 
 zm_backup_dir: str = f'{mount_point}/zm_cache'
 
-for index in df.index.tolist():
-    date: str = df.at[index, 'date']
-
-    zm_system_caches: list[str] = [f'{zm_dir}/{cache}/{date}' for cache in camera_caches]
-    zm_backup_caches: list[str] = [f'{zm_backup_dir}/{cache}/{date}' for cache in camera_caches]
-
-    hit: bool = False
-    
-    for cache in zm_system_caches:
-        # Iterate through the caches on the system. If the target cache is present there, hit will be made True here
-        if isdir(cache):
-            hit = True
-            df.at[index, 'status'] = 'on_system'
-            df.at[index, 'path'] = zm_dir
-            break
-
-    for cache in zm_backup_caches:
-        # Iterate through the caches on backup. If the target cache is present there, hit will be made True
-        if isdir(cache):
-            hit = True
-            df.at[index, 'status'] = 'on_backup'
-            df.at[index, 'path'] = zm_backup_dir
-            break
+# Cameras that were removed from ZoneMinder may still have footage on the backup disk
+caches: list[str] = sorted(set(camera_caches) | set(df['camera']))
+on_system: set[tuple[str, str]] = present_dirs(zm_dir, caches)
+on_backup: set[tuple[str, str]] = present_dirs(zm_backup_dir, caches)
 
-    # no matches were made
-    if not hit:
-        df.at[index, 'status'] = 'deleted'
-        df.at[index, 'path'] = None
+# Every row is one camera on one day, so each camera gets its own status. The day-level status (including 'split'
+# when some cameras are on the system and some on backup) is worked out by the zm_sizes view.
+camera_dates: pd.MultiIndex = pd.MultiIndex.from_frame(df[['camera', 'date']])
+df['status'] = np.select(
+    [camera_dates.isin(on_system), camera_dates.isin(on_backup)],
+    ['on_system', 'on_backup'],
+    'deleted'
+)
+df['location'] = df['status'].map({'on_system': zm_dir, 'on_backup': zm_backup_dir})  # None when deleted
 
 
 if save_to_db:
-    df.to_sql(
-        name='zm_sizes',
-        con=con,
-        if_exists='replace',
-        index=False
-    )
+    # Only the rows whose status or location changed are written
+    num_updated, num_inserted = save_changes(con, 'camera_sizes', old=df_saved, new=df, key=['date', 'camera'])
+    logger.info(f'Updated {num_updated} rows and inserted {num_inserted} rows in camera_sizes')
 else:
     logger.info(df)
 
@@ -0,0 +1,170 @@
+import sqlite3
+from os import getpid
+from threading import Lock
+from time import time
+
+
+class JobJournal:
+    """
+    Write-ahead journal of zm_move jobs in SQLite. Every job is written down as planned before it is scheduled, as
+    started when a worker picks it up and as done (or failed) when it ends, each in its own committed transaction. After
+    a crash or a power loss the next run reads back the jobs that never finished and picks them up again, instead of
+    scanning and archiving everything from scratch.
+
+    The journal also holds the run lock. The lock names the pid (and the start time of that pid) of the run holding it,
+    so a lock left behind by a run that died is noticed and taken over instead of blocking every later run.
+    """
+
+    unfinished_states: tuple[str, ...] = ('planned', 'started')
+    unfinished_marks: str = ', '.join('?' for _ in unfinished_states)  # placeholders for unfinished_states
+
+    class JournalLocked(Exception):
+        def __init__(self, message='Another run holds the journal lock'):
+            self.message = message
+            super().__init__(self.message)
+
+    def __init__(self, journal_file: str):
+        self.journal_file: str = journal_file
+        self.lock: Lock = Lock()  # jobs are journaled from the scheduler threads
+        self.con: sqlite3.Connection = sqlite3.connect(journal_file, check_same_thread=False)
+        self.con.row_factory = sqlite3.Row
+        self.con.execute('pragma journal_mode=wal')
+        self.con.execute('pragma synchronous=full')  # a committed state change survives a power loss
+
+        with self.con:
+            self.con.execute('''
+                create table if not exists jobs (
+                    id integer primary key,
+                    kind text not null,                 -- archive, move or delete
+                    source text not null,
+                    destination text,
+                    size integer not null default 0,    -- bytes to be archived, moved or deleted
+                    cache text,
+                    date text,
+                    codec text,
+                    state text not null,                -- planned, started, done, failed or skipped
+                    bytes_done integer not null default 0,
+                    planned_at real,
+                    started_at real,
+                    finished_at real,
+                    error text
+                )
+            ''')
+            self.con.execute('create index if not exists jobs_state on jobs(state)')
+            self.con.execute('''
+                create table if not exists journal_lock (
+                    id integer primary key check (id = 1),
+                    pid integer,
+                    pid_started integer,
+                    since real
+                )
+            ''')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def acquire(self) -> int | None:
+        """
+        Take the run lock. Raises JournalLocked if a live process holds it. Returns the pid of a dead run whose lock was
+        taken over (its unfinished jobs are in unfinished()), or None if the lock was free.
+        """
+        with self.lock, self.con:
+            self.con.execute('begin immediate')  # nobody else can check the lock between our read and our write
+            row: sqlite3.Row | None = self.con.execute('select pid, pid_started from journal_lock').fetchone()
+
+            if row and row['pid'] is not None and self.pid_alive(row['pid'], row['pid_started']):
+                raise self.JournalLocked(f'Run with pid {row["pid"]} holds the lock in {self.journal_file}')
+
+            self.con.execute(
+                'insert or replace into journal_lock (id, pid, pid_started, since) values (1, ?, ?, ?)',
+                (getpid(), self.process_start(getpid()), time())
+            )
+
+        return row['pid'] if row and row['pid'] is not None else None
+
+    def release(self) -> None:
+        with self.lock, self.con:
+            self.con.execute('update journal_lock set pid = null, pid_started = null where pid = ?', (getpid(),))
+
+    def plan(self, kind: str, source: str, destination: str | None = None, size: int = 0, cache: str | None = None,
+             date: str | None = None, codec: str | None = None) -> int:
+        """
+        Write down a job before it is scheduled. Returns its id. An unfinished job for the same kind and source (left
+        by a run that died) is planned again under its old id, so a job is never in the journal twice.
+        """
+        with self.lock, self.con:
+            row: sqlite3.Row | None = self.con.execute(
+                f'select id from jobs where kind = ? and source = ? and state in ({self.unfinished_marks})',
+                (kind, source, *self.unfinished_states)
+            ).fetchone()
+
+            if row:
+                self.con.execute(
+                    '''update jobs set destination = ?, size = ?, cache = ?, date = ?, codec = ?, state = 'planned',
+                       planned_at = ? where id = ?''',
+                    (destination, size, cache, date, codec, time(), row['id'])
+                )
+                return row['id']
+
+            return self.con.execute(
+                '''insert into jobs (kind, source, destination, size, cache, date, codec, state, planned_at)
+                   values (?, ?, ?, ?, ?, ?, ?, 'planned', ?)''',
+                (kind, source, destination, size, cache, date, codec, time())
+            ).lastrowid
+
+    def start(self, job_id: int) -> None:
+        self._set(job_id, 'started', 'started_at = ?', time())
+
+    def finish(self, job_id: int, bytes_done: int = 0) -> None:
+        self._set(job_id, 'done', 'finished_at = ?, bytes_done = ?', time(), bytes_done)
+
+    def fail(self, job_id: int, error: str = '') -> None:
+        self._set(job_id, 'failed', 'finished_at = ?, error = ?', time(), error)
+
+    def skip(self, job_id: int, reason: str = '') -> None:
+        self._set(job_id, 'skipped', 'finished_at = ?, error = ?', time(), reason)
+
+    def unfinished(self) -> list[sqlite3.Row]:
+        """Jobs that were planned or started but never finished. Deletes come first so they can make room."""
+        with self.lock:
+            return self.con.execute(
+                f'''select * from jobs where state in ({self.unfinished_marks})
+                    order by kind = 'delete' desc, size desc''',
+                self.unfinished_states
+            ).fetchall()
+
+    def prune(self, keep_days: int) -> int:
+        """Forget finished jobs older than keep_days. Returns how many were removed."""
+        with self.lock, self.con:
+            return self.con.execute(
+                f'delete from jobs where state not in ({self.unfinished_marks}) and finished_at < ?',
+                (*self.unfinished_states, time() - keep_days * 86400)
+            ).rowcount
+
+    def close(self) -> None:
+        self.con.close()
+
+    def _set(self, job_id: int, state: str, columns: str, *values) -> None:
+        with self.lock, self.con:
+            self.con.execute(f'update jobs set state = ?, {columns} where id = ?', (state, *values, job_id))
+
+    @staticmethod
+    def process_start(pid: int) -> int | None:
+        """Start time of a process in clock ticks since boot (field 22 of /proc/<pid>/stat). None if it is gone."""
+        try:
+            with open(f'/proc/{pid}/stat', 'r') as fh:
+                stat_line: str = fh.read()
+        except (FileNotFoundError, ProcessLookupError):
+            return None
+
+        # The command name in field 2 can hold spaces and parentheses, so count fields from the last ')'
+        return int(stat_line.rsplit(')', 1)[1].split()[19])
+
+    @classmethod
+    def pid_alive(cls, pid: int, pid_started: int | None = None) -> bool:
+        """True if the process is running and is the same process (not a later one that was given the same pid)"""
+        started: int | None = cls.process_start(pid)
+        return started is not None and (pid_started is None or started == pid_started)
@@ -1,26 +1,56 @@
 #!/usr/bin/python3
-from os import listdir, makedirs
-from os.path import islink, isdir
-from datetime import datetime as dt
-from threading import BoundedSemaphore
-from admintools import MyLogger, byte_sizer
-from shutil import copytree, rmtree, make_archive
-from threading import Thread
+import sqlite3
+from os import listdir, makedirs, cpu_count
+from os.path import islink, isdir, isfile, getsize, getmtime
+from datetime import datetime as dt, timedelta as td
+from admintools import MyLogger, byte_sizer, get_dir_size
+from shutil import rmtree
+from zm_archive import (
+    ArchiveError, archive_errors, make_archive, verify_archive, get_codec, codecs, estimate_ratio, choose_codec,
+    plan_parts, part_base_name, archive_parts, day_archives, remove_archive
+)
+from zm_transfer import move_tree, copy_tree
+from zm_manifest import verify_tree
+from threading import Lock
+from concurrent.futures import Future
+from zm_scheduler import JobScheduler, JobSkipped, SpaceLedger
+from zm_journal import JobJournal
+from zm_reaper import Reaper
+from zm_throttle import Throttle, devices_of
+from zm_db import connect, create_codec_table, last_codec_sample, record_codec_choice
+from typing import Callable
 from logging import Logger
 
 
 # Zm-Move. user defined vars
 working_dir: str = '/nfs_share/matt_desktop/server_scripts/zm_helper/'
-semaphore: BoundedSemaphore = BoundedSemaphore(5)  # How many simultaneous processes to allow at once
+io_workers: int = 5      # How many delete/move jobs to run at once
+cpu_workers: int = 2     # How many archive jobs to run at once. Each one already compresses on every core
+cpu_pool_type: str = 'thread'  # Run archive jobs on 'thread' or 'process' workers
+pipelined: bool = True   # Run backup deletes and archives at the same time instead of one phase after the other
 disk_uuid: str = '244815e3-6ef8-450b-b12c-6bcd1df08fa1'  # UUID of backup disk. $ blkid -o value -s UUID /dev/sdxx
 log_file_name: str = '/var/log/zm_move.log'
 db_log_file: str = '/var/log/zm_size.log'
 mount_point: str = '/mnt/7'
+disk_stats_ttl: float = 5.0  # Seconds that backup disk stats (one statvfs call) may be reused before re-reading
 keep_days: int = 90     # How long to keep videos on system before moving to backup
 delete_days: int = 150  # How long to keep videos on backup before permanently deleting
 max_threads: int = 30   # Max number of jobs per day
+archive_codec: str = 'adaptive'  # adaptive, tar, bzip2, xz or zstd (needs the zstandard package). See zm_archive.py
+archive_index: bool = True  # Give every event its own blocks and write an index beside the archive (zm_restore.py)
+adaptive_heavy_codec: str = 'bzip2'  # What adaptive picks for footage that compresses well
+adaptive_resample_days: int = 7      # Days the codec picked for a camera is reused before its footage is sampled again
+archive_workers: int = cpu_count() or 1  # Cores shared by all archive jobs for compression
+archive_part_size: int = 20 * 1024 ** 3  # Bigger camera-days are archived in parts (.partNNN) side by side. 0 is off
+reaper_workers: int = 4  # Files unlinked at once by the background deleter, on top of io_workers
+copy_workers: int = 16  # Files copied at once by each move job. Event directories are many small frames
+move_compare: str = 'stat'  # Files already on backup are skipped if they match: 'stat' (size+mtime), 'checksum', 'none'
+verify_backups: str = 'members'  # Check backups before their source is deleted: 'members', 'archive' or 'none'
+# 'members' decompresses archives and compares every file. 'archive' only re-reads the archive. See zm_verify.py
 zm_dir: str = '/var/cache/zoneminder/events'
 save_dir: str = f'{mount_point}/zm_cache'
+restore_dir: str = f'{mount_point}/zm_restore'  # Where zm_restore.py puts restored events by default
+restore_workers: int = cpu_count() or 1  # Archives/events zm_restore.py extracts at once
 camera_caches: list[str] = [
     directory for directory in listdir(zm_dir)
     if islink(f'{zm_dir}/{directory}')
@@ -36,6 +66,27 @@ date_fmt: str = '%Y-%m-%d'
 db_file: str = f'{working_dir}/zm_size.db'
 today_date: str = dt.strftime(dt.now(), '%Y-%m-%d')  # YYYY-MM-DD
 
+# Zm_Accountd (inotify size tracking)
+accountd_flush_seconds: int = 60  # How often changed sizes are written to the database
+accountd_watch_days: int = 2      # How many of the newest date directories to watch in each cache
+
+# Zm_Move job journal. Also the run lock. Keep it on a local disk, SQLite does not lock reliably over NFS
+journal_file: str = f'{zm_dir}/.zm_move.journal'
+journal_keep_days: int = 30  # How long finished jobs are kept in the journal
+
+# Throttling. Keeps archive, move and delete jobs from starving ZoneMinder of disk time while it is recording
+throttle_bandwidth: int = 0         # Bytes per second read/written by all jobs together. 0 is no cap.
+                                    # With cpu_pool_type='process' every archive process has a cap of its own
+throttle_latency_ms: float = 25.0   # Average disk latency to aim for on the camera disks. 0 turns this off
+throttle_max_slots: int = 16        # Files/blocks/batches in flight at once while the disks keep up
+
+throttle: Throttle = Throttle(
+    bandwidth=throttle_bandwidth,
+    max_slots=throttle_max_slots,
+    target_latency_ms=throttle_latency_ms,
+    devices=devices_of(f'{zm_dir}/{cache}' for cache in camera_caches)
+)
+
 
 logger: Logger = MyLogger(
     name='zm_mover',
@@ -46,84 +97,566 @@ logger: Logger = MyLogger(
 
 
 class ZmHelper:
-    def __init__(self):
+    def __init__(self, scheduler: JobScheduler | None = None, journal: JobJournal | None = None):
+        self.scheduler: JobScheduler = scheduler or JobScheduler(
+            io_workers=io_workers,
+            cpu_workers=cpu_workers,
+            cpu_pool_type=cpu_pool_type
+        )
+        self.journal: JobJournal | None = journal  # every job is written down here, so a crashed run can be resumed
+        self.reaper: Reaper = Reaper(workers=reaper_workers, throttle=throttle)  # deletes trashed directories
+        self.lock: Lock = Lock()  # guards the counters below. They are updated from the worker threads
         self.archive_counter: int = 0
         self.move_counter: int = 0
         self.delete_counter: int = 0
-        self.archive_threads: list[Thread] = []
-        self.move_threads: list[Thread] = []
-        self.delete_threads: list[Thread] = []
-
-    def move_worker(self, move_source: str, move_destination: str, move_size: int, move_cache_name: str) -> None:
-        """Copies the source to the destination, then deletes the source."""
-        with semaphore:
-            start: dt = dt.now()
-            human_readable_size: str = byte_sizer(move_size)
-
-            if isdir(move_destination):
-                logger.warning(f'{move_source} already exists in {move_destination}. '
-                               f'Replacing now! -- {human_readable_size}')
-            else:
-                logger.info(f'Creating {move_destination}. Beginning backup. {human_readable_size}')
-                makedirs(move_destination)
-
-            copytree(src=move_source, dst=move_destination, dirs_exist_ok=True)
-
-            if allow_delete:  # deletion is optional
-                rmtree(move_source)
+        self.archive_jobs: list[Future] = []
+        self.move_jobs: list[Future] = []
+        self.delete_jobs: list[Future] = []
+
+    def submit_move(self, move_source: str, move_destination: str, move_size: int, move_cache_name: str) -> Future:
+        """Schedule move_worker(). The future holds the run time of the job."""
+        job_id: int | None = self._plan('move', move_source, move_destination, move_size, move_cache_name)
+        future: Future = self.scheduler.submit(
+            self.move_worker, move_source, move_destination, move_size, move_cache_name,
+            size=move_size, kind='io', name=move_source, gate=self._gate(job_id)
+        )
+        self.move_jobs.append(future)
+        future.add_done_callback(
+            lambda job: self._move_done(job, move_source, move_destination, move_size, move_cache_name, job_id)
+        )
+        return future
+
+    def submit_archive(self, archive_source: str, archive_destination: str, archive_size: int,
+                       archive_cache_name: str, archive_date: str, compression_type: str = archive_codec,
+                       ledger: SpaceLedger | None = None) -> Future:
+        """
+        Schedule archive_worker(). The future holds the run time of the job. With a ledger the job waits until the
+        backup disk has room for it, and is skipped if it never will. Camera-days bigger than archive_part_size may be
+        split into parts that are archived side by side (see _submit_split()).
+        """
+        job_id: int | None = self._plan('archive', archive_source, archive_destination, archive_size,
+                                        archive_cache_name, archive_date, compression_type)
+
+        if archive_part_size and archive_size > archive_part_size:
+            future: Future = self._submit_split(archive_source, archive_destination, archive_size, archive_cache_name,
+                                                archive_date, compression_type, ledger, job_id)
+            ledger = None  # the jobs it schedules reserve and release their own space
+        else:
+            future: Future = self._submit_whole(archive_source, archive_destination, archive_size,
+                                                archive_cache_name, archive_date, compression_type, ledger, job_id)
+
+        self.archive_jobs.append(future)
+        future.add_done_callback(
+            lambda job: self._archive_done(job, archive_source, archive_destination, archive_size, archive_cache_name,
+                                           archive_date, compression_type, ledger, job_id)
+        )
+        return future
+
+    def _submit_whole(self, archive_source: str, archive_destination: str, archive_size: int,
+                      archive_cache_name: str, archive_date: str, compression_type: str,
+                      ledger: SpaceLedger | None = None, job_id: int | None = None) -> Future:
+        return self.scheduler.submit(
+            self.archive_worker, archive_source, archive_destination, archive_size, archive_cache_name, archive_date,
+            compression_type, size=archive_size, kind='cpu', name=archive_source,
+            gate=self._gate(job_id, (lambda: ledger.reserve(archive_size)) if ledger else None)
+        )
+
+    def _submit_split(self, archive_source: str, archive_destination: str, archive_size: int,
+                      archive_cache_name: str, archive_date: str, compression_type: str,
+                      ledger: SpaceLedger | None = None, job_id: int | None = None) -> Future:
+        """
+        Schedule split_worker() for a big camera-day. Once it has crawled the day, the day is archived in parts (see
+        _submit_parts()), or as one archive if it does not split. Returns a future for the whole day.
+        """
+        day: Future = Future()
+        day.set_running_or_notify_cancel()
+
+        def split_done(split: Future) -> None:
+            if split.exception():
+                day.set_exception(split.exception())
+                return
 
-            self.move_counter += 1
-
-            logger.info(f'''
-                       Cache: {move_cache_name.upper()}
-                      Source: {move_source}
-                     Job num: {self.move_counter} of {len(self.move_threads)}
-                        Size: {human_readable_size}
-                 Destination: {move_destination}
-                    Run time: {dt.now() - start}
-                ''')
-
-    def archive_worker(self, archive_source: str, archive_destination: str, archive_size: int,
-                       archive_cache_name: str, archive_date: str, compression_type: str = 'bztar') -> None:
-        """Archives (with compression) the source to the destination, then deletes the source."""
-        with semaphore:
-            start: dt = dt.now()
-
-            if not isdir(archive_destination):
-                logger.debug(f'{archive_destination} does not exist. Creating now.')
-                makedirs(archive_destination)
-
-            human_readable_size: str = byte_sizer(archive_size)
-            logger.info(f'Beginning backup now {archive_destination} ({human_readable_size})')
-
-            if not isdir(archive_destination):
-                logger.info(f'Creating {archive_destination}')
-                makedirs(archive_destination)
-
-            make_archive(
-                base_name=f'{archive_destination}/{archive_date}_{archive_cache_name}',
-                root_dir=archive_source,
-                base_dir=archive_source,
-                format=compression_type
+            parts, codec, level, sampled_ratio = split.result()
+
+            if len(parts) > 1:
+                self._submit_parts(day, archive_source, archive_destination, archive_cache_name, archive_date, codec,
+                                   level, compression_type == 'adaptive', sampled_ratio, parts, ledger, job_id)
+                return
+
+            whole: Future = self._submit_whole(archive_source, archive_destination, archive_size,
+                                               archive_cache_name, archive_date, compression_type, ledger, job_id)
+            whole.add_done_callback(lambda job: self._whole_done(job, day, archive_size, ledger))
+
+        self.scheduler.submit(
+            self.split_worker, archive_source, archive_cache_name, compression_type, size=archive_size, kind='io',
+            name=f'{archive_source} split'
+        ).add_done_callback(split_done)
+        return day
+
+    @staticmethod
+    def _whole_done(job: Future, day: Future, archive_size: int, ledger: SpaceLedger | None = None) -> None:
+        """Hand the outcome of a day that did not split on to its day future"""
+        if job.exception():
+            if ledger and not isinstance(job.exception(), JobSkipped):
+                ledger.release(archive_size)
+            day.set_exception(job.exception())
+        else:
+            day.set_result(job.result())
+
+    @staticmethod
+    def split_worker(archive_source: str, archive_cache_name: str,
+                     compression_type: str) -> tuple[list[tuple[list[str], int]], str, int | None, float | None]:
+        """
+        Crawl a big camera-day for the parts it is archived in (see plan_parts() in zm_archive.py), and pick the one
+        codec all of its parts use. Returns (parts, codec, level, sampled ratio).
+        """
+        parts: list[tuple[list[str], int]] = plan_parts(archive_source, archive_part_size)
+        level: int | None = None
+        sampled_ratio: float | None = None
+
+        if compression_type == 'adaptive' and len(parts) > 1:
+            compression_type, level, sampled_ratio = ZmHelper.adaptive_codec(archive_source, archive_cache_name)
+
+        return parts, compression_type, level, sampled_ratio
+
+    def _submit_parts(self, day: Future, archive_source: str, archive_destination: str, archive_cache_name: str,
+                      archive_date: str, compression_type: str, level: int | None, adaptive: bool,
+                      sampled_ratio: float | None, parts: list[tuple[list[str], int]],
+                      ledger: SpaceLedger | None = None, job_id: int | None = None) -> None:
+        """
+        Schedule one archive_part_worker() for every part of a camera-day that is too big for one job, so one busy
+        camera does not keep a single core busy long after the other jobs are done. The day future gets the summed run
+        time of the parts. The source is deleted once the last part is done, and only if every part was written and
+        verified.
+        """
+        logger.info(f'Splitting {archive_source} into {len(parts)} parts of up to {byte_sizer(archive_part_size)}')
+        remaining: list[int] = [len(parts)]  # parts not done yet. Counted down under self.lock
+        part_jobs: list[Future] = [
+            self.scheduler.submit(
+                self.archive_part_worker, archive_source, archive_destination, archive_cache_name, archive_date,
+                compression_type, level, number, members, size=part_size, kind='cpu',
+                name=f'{archive_source} part {number}',
+                gate=self._gate(job_id, (lambda part_size=part_size: ledger.reserve(part_size)) if ledger else None)
             )
+            for number, (members, part_size) in enumerate(parts, 1)
+        ]
+
+        def part_done(job: Future, part_size: int) -> None:
+            if job.exception() and not isinstance(job.exception(), JobSkipped):
+                if ledger:
+                    ledger.release(part_size)
+                logger.error(f'Archive part failed {archive_source} -- {job.exception()!r}')
+
+            with self.lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+
+            self._finish_parts(day, part_jobs, archive_source, archive_destination, archive_cache_name, archive_date,
+                               compression_type, level, adaptive, sampled_ratio,
+                               sum(part_size for _, part_size in parts))
+
+        for part_job, (_, part_size) in zip(part_jobs, parts):
+            part_job.add_done_callback(lambda job, part_size=part_size: part_done(job, part_size))
+
+    @staticmethod
+    def _finish_parts(day: Future, part_jobs: list[Future], archive_source: str, archive_destination: str,
+                      archive_cache_name: str, archive_date: str, compression_type: str, level: int | None,
+                      adaptive: bool, sampled_ratio: float | None, archive_size: int) -> None:
+        """Called by whichever part is done last. Deletes the source, or fails the day if a part did not make it."""
+        errors: list[BaseException] = [job.exception() for job in part_jobs if job.exception()]
+
+        if errors:
+            failed: list[BaseException] = [error for error in errors if not isinstance(error, JobSkipped)]
+            day.set_exception((failed or errors)[0])
+            return
+
+        base_name: str = f'{archive_destination}/{archive_date}_{archive_cache_name}'
+        extension: str = get_codec(compression_type).extension
+        written: list[str] = [
+            f'{part_base_name(base_name, number)}.{extension}' for number in range(1, len(part_jobs) + 1)
+        ]
+
+        try:
+            for stale in set(day_archives(base_name)) - set(written):  # a whole archive or differently split parts
+                remove_archive(stale)
+
+            if adaptive:
+                con: sqlite3.Connection = connect(db_file)
+                with con:
+                    record_codec_choice(con, archive_cache_name, archive_date, compression_type, level, sampled_ratio,
+                                        today_date if sampled_ratio is not None else None, archive_size,
+                                        sum(getsize(part) for part in written))
+                con.close()
 
             if allow_delete:
                 rmtree(archive_source)
+        except (OSError, sqlite3.Error) as error:
+            day.set_exception(error)
+            return
+
+        day.set_result(sum((job.result() for job in part_jobs), td()))
+
+    def submit_delete(self, del_path: str, del_size: int, ledger: SpaceLedger | None = None) -> Future:
+        """
+        Schedule delete_worker(). The job is done once the directory is in the trash, the reaper frees the space after.
+        With a ledger, del_size (what it takes up on disk) goes to waiting archive jobs once the reaper has freed it.
+        """
+        if ledger:
+            ledger.expect(del_size)
+
+        job_id: int | None = self._plan('delete', del_path, size=del_size)
+        future: Future = self.scheduler.submit(self.delete_worker, del_path, del_size, size=del_size, kind='io',
+                                               name=del_path, gate=self._gate(job_id))
+        self.delete_jobs.append(future)
+        future.add_done_callback(lambda job: self._delete_done(job, del_path, del_size, ledger, job_id))
+        return future
+
+    def run(self) -> None:
+        """Start the scheduler on everything that has been submitted so far"""
+        self.scheduler.start()
+
+    def resume(self, ledger: SpaceLedger | None = None) -> set[str]:
+        """
+        Schedule the jobs that a run which died left unfinished in the journal. An archive that was written but whose
+        source was not deleted yet only gets the delete. Returns the sources, so the scan for new jobs can skip them.
+        """
+        resumed: set[str] = set()
+
+        if not self.journal:
+            return resumed
+
+        for row in self.journal.unfinished():
+            job_id, kind, source, size = row['id'], row['kind'], row['source'], row['size']
+
+            if (kind == 'delete' and not allow_delete) or (kind in ('archive', 'move') and not allow_move):
+                continue
+
+            if kind == 'delete':
+                if isdir(source) and source.startswith(save_dir):
+                    # Only deletes on the backup disk make room for archives, and only as much as is left of them
+                    self.submit_delete(source, get_dir_size(source, apparent=False), ledger=ledger)
+                elif isdir(source):
+                    self.submit_delete(source, size)
+                else:
+                    self.journal.finish(job_id, size)
+            elif kind == 'archive':
+                archive: str = self.archive_path(row['destination'], row['cache'], row['date'], row['codec'])
+
+                if (row['state'] == 'started' and isfile(archive) and getmtime(archive) >= row['started_at']
+                        and not self.verify_archive(archive)):
+                    self.journal.finish(job_id, getsize(archive))
+
+                    if allow_delete and isdir(source):
+                        self.submit_delete(source, size)
+                elif isdir(source):
+                    self.submit_archive(source, row['destination'], size, row['cache'], row['date'], row['codec'],
+                                        ledger=ledger)
+                elif archive_parts(f'{row["destination"]}/{row["date"]}_{row["cache"]}'):
+                    self.journal.finish(job_id, size)  # the source is only deleted once every part is verified
+                else:
+                    self.journal.fail(job_id, 'source is gone and the archive was not finished')
+            elif kind == 'move':
+                if isdir(source):
+                    self.submit_move(source, row['destination'], size, row['cache'])
+                elif isdir(row['destination']):
+                    self.journal.finish(job_id, size)  # it was renamed
+                else:
+                    self.journal.fail(job_id, 'source and destination are both gone')
+
+            resumed.add(source)
+
+        if resumed:
+            logger.warning(f'Resumed {len(resumed)} unfinished jobs from {self.journal.journal_file}')
+
+        return resumed
+
+    def _plan(self, kind: str, source: str, destination: str | None = None, size: int = 0, cache: str | None = None,
+              date: str | None = None, codec: str | None = None) -> int | None:
+        """Write a job down in the journal before it is scheduled. Returns its journal id, or None without a journal."""
+        if not self.journal:
+            return None
+
+        return self.journal.plan(kind, source, destination, size, cache, date, codec)
+
+    def _gate(self, job_id: int | None, check: Callable[[], bool] | None = None) -> Callable[[], bool] | None:
+        """Gate that runs check (if any), then marks the job as started in the journal"""
+        if job_id is None:
+            return check
+
+        def gate() -> bool:
+            if check and not check():
+                return False
+
+            self.journal.start(job_id)
+            return True
+
+        return gate
+
+    def _journal_done(self, job: Future, job_id: int | None, bytes_done: int = 0) -> None:
+        if job_id is None:
+            return
+
+        if isinstance(job.exception(), JobSkipped):
+            self.journal.skip(job_id, str(job.exception()))
+        elif job.exception():
+            self.journal.fail(job_id, repr(job.exception()))
+        else:
+            self.journal.finish(job_id, bytes_done)
+
+    def _count(self, counter: str) -> int:
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+            return getattr(self, counter)
+
+    def _move_done(self, job: Future, move_source: str, move_destination: str, move_size: int,
+                   move_cache_name: str, job_id: int | None = None) -> None:
+        self._journal_done(job, job_id, move_size)
+
+        if job.exception():
+            logger.error(f'Move failed {move_source} -- {job.exception()!r}')
+            return
+
+        job_num: int = self._count('move_counter')
+        logger.info(f'''
+                   Cache: {move_cache_name.upper()}
+                  Source: {move_source}
+                 Job num: {job_num} of {len(self.move_jobs)}
+                    Size: {byte_sizer(move_size)}
+             Destination: {move_destination}
+                Run time: {job.result()}
+            ''')
+
+    def _archive_done(self, job: Future, archive_source: str, archive_destination: str, archive_size: int,
+                      archive_cache_name: str, archive_date: str, compression_type: str,
+                      ledger: SpaceLedger | None = None, job_id: int | None = None) -> None:
+        archive: str = self.archive_path(archive_destination, archive_cache_name, archive_date, compression_type)
+        archives: list[str] = [archive] if isfile(archive) else archive_parts(
+            f'{archive_destination}/{archive_date}_{archive_cache_name}'
+        )
+        self._journal_done(job, job_id, sum(getsize(path) for path in archives))
+
+        if isinstance(job.exception(), JobSkipped):
+            logger.error(f'Not enough space on the backup disk for {archive_source} ({byte_sizer(archive_size)}). '
+                         f'Skipping!')
+            return
+        elif job.exception():
+            if ledger:
+                ledger.release(archive_size)
+            logger.error(f'Archive failed {archive_source} -- {job.exception()!r}')
+            return
+
+        job_num: int = self._count('archive_counter')
+        logger.info(f'''
+                   Cache: {archive_cache_name.upper()}
+                  Source: {archive_source}
+                 Job num: {job_num} of {len(self.archive_jobs)}
+                    Size: {byte_sizer(archive_size)}
+             Destination: {archive_destination}
+                Run time: {job.result()}
+            ''')
+
+    def _delete_done(self, job: Future, del_path: str, del_size: int, ledger: SpaceLedger | None = None,
+                     job_id: int | None = None) -> None:
+        self._journal_done(job, job_id, del_size)
+
+        if job.exception():
+            if ledger:
+                ledger.credit(del_size, success=False)
+            logger.error(f'Delete failed {del_path} -- {job.exception()!r}')
+            return
+
+        job.result().add_done_callback(lambda reap: self._reap_done(reap, del_path, del_size, ledger))
+
+    def _reap_done(self, reap: Future, del_path: str, del_size: int, ledger: SpaceLedger | None = None) -> None:
+        if ledger:
+            ledger.credit(del_size, success=reap.exception() is None)
+
+        if reap.exception():
+            logger.error(f'Delete failed {del_path}. It is left in the trash -- {reap.exception()!r}')
+            return
+
+        self._count('delete_counter')
+        logger.info(f'Finished deleting {del_path} ({byte_sizer(del_size)}, {reap.result()} files)')
+
+    @staticmethod
+    def move_worker(move_source: str, move_destination: str, move_size: int, move_cache_name: str) -> td:
+        """
+        Moves the source to the destination. Within one filesystem this is a rename, otherwise the files are copied in
+        parallel by the kernel (see zm_transfer.py) and the source is deleted afterwards.
+        """
+        start: dt = dt.now()
+        human_readable_size: str = byte_sizer(move_size)
+
+        if isdir(move_destination):
+            logger.warning(f'{move_source} already exists in {move_destination}. '
+                           f'Copying what is missing or changed ({move_compare}) -- {human_readable_size}')
+        else:
+            logger.info(f'Creating {move_destination}. Beginning backup. {human_readable_size}')
+
+        manifest: bool = verify_backups != 'none'
+
+        if allow_delete:  # deletion is optional. Without it the source has to stay, so it is always copied
+            if move_tree(move_source, move_destination, workers=copy_workers, compare=move_compare,
+                         throttle=throttle, manifest=manifest) == 'copied':
+                if manifest:
+                    problems: list[str] = verify_tree(move_destination, workers=copy_workers, uncached=True)
+                    if problems:
+                        raise OSError(f'{move_destination} failed verification, {move_source} is kept: '
+                                      f'{"; ".join(problems[:5])}')
+                rmtree(move_source)
+        else:
+            copy_tree(move_source, move_destination, workers=copy_workers, compare=move_compare, throttle=throttle,
+                      manifest=manifest)
+
+        return dt.now() - start
+
+    @staticmethod
+    def archive_path(archive_destination: str, archive_cache_name: str, archive_date: str,
+                     compression_type: str = archive_codec) -> str:
+        """
+        Where archive_worker() puts the archive of a camera/date. For adaptive archives this is whichever one exists, or
+        the one the heavy codec would write.
+        """
+        base_name: str = f'{archive_destination}/{archive_date}_{archive_cache_name}'
+
+        if compression_type != 'adaptive':
+            return f'{base_name}.{get_codec(compression_type).extension}'
+
+        for codec in codecs.values():
+            if isfile(f'{base_name}.{codec.extension}'):
+                return f'{base_name}.{codec.extension}'
+
+        return f'{base_name}.{get_codec(adaptive_heavy_codec).extension}'
+
+    @staticmethod
+    def adaptive_codec(archive_source: str, archive_cache_name: str) -> tuple[str, int | None, float | None]:
+        """
+        Pick the codec for a camera/date from a sample of its files (see estimate_ratio() in zm_archive.py). A sample of
+        the same camera from the last adaptive_resample_days is reused instead. Returns (codec, level, sampled ratio),
+        the ratio being None when an earlier sample was reused.
+        """
+        since: str = dt.strftime(dt.now() - td(days=adaptive_resample_days), date_fmt)
+        con: sqlite3.Connection = connect(db_file)
+        create_codec_table(con)
+        last_sample: tuple[str, int | None, float] | None = last_codec_sample(con, archive_cache_name, since)
+        con.close()
+
+        if last_sample:
+            codec, level, _ = last_sample
+            return codec, level, None
+
+        ratio, ratios = estimate_ratio(archive_source)
+        codec, level = choose_codec(ratio, heavy=adaptive_heavy_codec)
+        logger.info(f'{archive_source} compresses to about {ratio:.0%} '
+                    f'({", ".join(f"{ext or None} {r:.0%}" for ext, r in ratios.items())}). Using {codec}.')
+        return codec, level, ratio
+
+    @staticmethod
+    def archive_worker(archive_source: str, archive_destination: str, archive_size: int,
+                       archive_cache_name: str, archive_date: str, compression_type: str = archive_codec) -> td:
+        """
+        Archives (with compression) the source to the destination, then deletes the source. With the adaptive codec the
+        codec is picked from the footage, and the choice and the ratio it achieved are recorded in archive_codecs.
+        """
+        start: dt = dt.now()
+        level: int | None = None
+        sampled_ratio: float | None = None
+        adaptive: bool = compression_type == 'adaptive'
+
+        if adaptive:
+            compression_type, level, sampled_ratio = ZmHelper.adaptive_codec(archive_source, archive_cache_name)
+
+        if not isdir(archive_destination):
+            logger.debug(f'{archive_destination} does not exist. Creating now.')
+            makedirs(archive_destination, exist_ok=True)
+
+        human_readable_size: str = byte_sizer(archive_size)
+        logger.info(f'Beginning backup now {archive_destination} ({human_readable_size})')
+
+        archive: str = make_archive(
+            base_name=f'{archive_destination}/{archive_date}_{archive_cache_name}',
+            root_dir=archive_source,
+            base_dir=archive_source,
+            compression_type=compression_type,
+            level=level,
+            workers=archive_workers,
+            throttle=throttle,
+            index=archive_index,
+            manifest=verify_backups != 'none'
+        )
+
+        if adaptive:
+            con: sqlite3.Connection = connect(db_file)
+            with con:
+                record_codec_choice(con, archive_cache_name, archive_date, compression_type, level, sampled_ratio,
+                                    today_date if sampled_ratio is not None else None, archive_size, getsize(archive))
+            con.close()
+
+        problems: list[str] = ZmHelper.verify_archive(archive)
+        if problems:
+            raise ArchiveError(f'{archive} failed verification, {archive_source} is kept: {"; ".join(problems[:5])}')
+
+        for stale in set(day_archives(f'{archive_destination}/{archive_date}_{archive_cache_name}')) - {archive}:
+            remove_archive(stale)  # parts, or an archive in another codec, from an earlier run of this day
+
+        if allow_delete:
+            rmtree(archive_source)
+
+        return dt.now() - start
+
+    @staticmethod
+    def archive_part_worker(archive_source: str, archive_destination: str, archive_cache_name: str,
+                            archive_date: str, compression_type: str, level: int | None, number: int,
+                            members: list[str]) -> td:
+        """
+        Archives some of the events of a camera-day as one part of a multi-volume archive set, and verifies it. The
+        source is left alone, it is deleted once every part is done (see _submit_parts()).
+        """
+        start: dt = dt.now()
+        makedirs(archive_destination, exist_ok=True)
+        logger.info(f'Beginning backup now {archive_destination} part {number} ({len(members)} events)')
+
+        archive: str = make_archive(
+            base_name=part_base_name(f'{archive_destination}/{archive_date}_{archive_cache_name}', number),
+            root_dir=archive_source,
+            base_dir=archive_source,
+            compression_type=compression_type,
+            level=level,
+            workers=archive_workers,
+            throttle=throttle,
+            index=archive_index,
+            manifest=verify_backups != 'none',
+            members=members
+        )
+
+        problems: list[str] = ZmHelper.verify_archive(archive)
+        if problems:
+            raise ArchiveError(f'{archive} failed verification, {archive_source} is kept: {"; ".join(problems[:5])}')
+
+        return dt.now() - start
+
+    @staticmethod
+    def verify_archive(archive: str) -> list[str]:
+        """
+        Read a new archive back from the disk and check it against the manifest written with it, as set by
+        verify_backups. Returns the problems; an empty list means the source may be deleted. An archive or manifest
+        that can not even be read (torn by a power loss, say) is a problem too, not an error.
+        """
+        if verify_backups == 'none':
+            return []
+
+        started: dt = dt.now()
+
+        try:
+            problems: list[str] = verify_archive(archive, deep=verify_backups == 'members', workers=archive_workers,
+                                                 uncached=True)
+        except archive_errors as error:
+            problems = [f'{archive} could not be verified -- {error!r}']
+
+        logger.debug(f'Verified {archive} ({verify_backups}) in {dt.now() - started}')
+        return problems
 
-            self.archive_counter += 1
-
-            logger.info(f'''
-                       Cache: {archive_cache_name.upper()}
-                      Source: {archive_source}
-                     Job num: {self.archive_counter} of {len(self.archive_threads)}
-                        Size: {human_readable_size}
-                 Destination: {archive_destination}
-                    Run time: {dt.now() - start}
-                ''')
-
-    def delete_worker(self, del_path, del_size) -> None:
-        """Only deletes the source."""
-        with semaphore:
-            human_readable_size = byte_sizer(del_size)
-            rmtree(del_path)
-            logger.info(f'Finished deleting {del_path} ({human_readable_size})')
+    def delete_worker(self, del_path: str, del_size: int) -> Future:
+        """Moves the source into the trash. Returns the future of the reaper deleting it."""
+        return self.reaper.trash(del_path)
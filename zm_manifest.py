@@ -0,0 +1,199 @@
+import io
+import json
+import hashlib
+import tarfile
+from os import open as os_open, close, fsync, posix_fadvise, replace, O_RDONLY, POSIX_FADV_DONTNEED
+from os.path import isfile, join, dirname
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO
+
+
+# Everything is hashed with sha256. hashlib releases the GIL on large buffers, so threads hash on every core.
+chunk_size: int = 1024 ** 2
+tree_manifest_name: str = '.zm_manifest.json'  # inside a copied directory
+
+
+class HashingReader:
+    """Wraps a file that is being read, and hashes everything read from it on the way through"""
+
+    def __init__(self, fileobj: BinaryIO):
+        self.fileobj: BinaryIO = fileobj
+        self.hash = hashlib.sha256()
+        self.size: int = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data: bytes = self.fileobj.read(size)
+        self.hash.update(data)
+        self.size += len(data)
+        return data
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+
+class HashingTarFile(tarfile.TarFile):
+    """A TarFile that records the size and sha256 of every file as it is added, while tarfile reads it anyway"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.digests: dict[str, tuple[int, str]] = {}  # member name: (size, sha256)
+
+    def addfile(self, tarinfo: tarfile.TarInfo, fileobj: BinaryIO | None = None) -> None:
+        if fileobj is None:
+            return super().addfile(tarinfo)
+
+        reader: HashingReader = HashingReader(fileobj)
+        super().addfile(tarinfo, reader)
+        self.digests[tarinfo.name] = (reader.size, reader.hexdigest())
+
+
+def manifest_path(archive_path: str) -> str:
+    return f'{archive_path}.manifest.json'
+
+
+def write_manifest(path: str, manifest: dict) -> None:
+    """
+    Write a manifest next to what it describes. It is written to a .part file first, like the archives, and is on the
+    disk before it is renamed, so a power loss leaves the old manifest or the new one but never a torn one.
+    """
+    with open(f'{path}.part', 'w') as fh:
+        json.dump(manifest, fh)
+        flush_to_disk(fh)
+
+    replace(f'{path}.part', path)
+    sync_directory(dirname(path) or '.')
+
+
+def flush_to_disk(fh) -> None:
+    """Flush an open file all the way to the disk"""
+    fh.flush()
+    fsync(fh.fileno())
+
+
+def sync_directory(path: str) -> None:
+    """Make the renames in a directory durable"""
+    fd: int = os_open(path, O_RDONLY)
+
+    try:
+        fsync(fd)
+    finally:
+        close(fd)
+
+
+def read_manifest(path: str) -> dict:
+    with open(path, 'r') as fh:
+        return json.load(fh)
+
+
+def drop_cache(path: str) -> None:
+    """
+    Flush a file to disk and drop it from the page cache, so the next read comes from the disk. Verifying a file that
+    was just written would otherwise only check the copy in memory.
+    """
+    fd: int = os_open(path, O_RDONLY)
+
+    try:
+        fsync(fd)
+        posix_fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+    finally:
+        close(fd)
+
+
+def file_digest(path: str, uncached: bool = False) -> tuple[int, str]:
+    """(size, sha256) of a file"""
+    if uncached:
+        drop_cache(path)
+
+    hasher = hashlib.sha256()
+    size: int = 0
+
+    with open(path, 'rb') as fh:
+        while True:
+            data: bytes = fh.read(chunk_size)
+            if not data:
+                break
+            hasher.update(data)
+            size += len(data)
+
+    return size, hasher.hexdigest()
+
+
+def stream_digests(fileobj: BinaryIO) -> dict[str, tuple[int, str]]:
+    """(size, sha256) of every file in a tar stream, read once from start to end"""
+    digests: dict[str, tuple[int, str]] = {}
+
+    with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+
+            reader: HashingReader = HashingReader(tar.extractfile(member))
+            while reader.read(chunk_size):
+                pass
+            digests[member.name] = (reader.size, reader.hexdigest())
+
+    return digests
+
+
+def compare_digests(expected: dict[str, list | tuple], found: dict[str, list | tuple], where: str) -> list[str]:
+    """Problems between the digests in a manifest and the digests that were found. An empty list means all is well."""
+    problems: list[str] = []
+
+    for name, (size, digest) in expected.items():
+        if name not in found:
+            problems.append(f'{where}: {name} is missing')
+        elif found[name][0] != size:
+            problems.append(f'{where}: {name} has {found[name][0]} bytes, expected {size}')
+        elif found[name][1] != digest:
+            problems.append(f'{where}: {name} has a different sha256')
+
+    problems += [f'{where}: {name} is not in the manifest' for name in found if name not in expected]
+    return problems
+
+
+def verify_tree(directory: str, workers: int | None = None, uncached: bool = False) -> list[str]:
+    """
+    Check a copied directory against its manifest. Every file in the manifest is hashed again. Files that are not in
+    the manifest (left in the destination by an earlier copy) are not part of the backup and are not looked at.
+    Returns the problems found; an empty list means all is well.
+    """
+    manifest_file: str = join(directory, tree_manifest_name)
+
+    if not isfile(manifest_file):
+        return [f'{directory} has no manifest']
+
+    expected: dict[str, list] = read_manifest(manifest_file)['files']
+
+    def digest(name: str) -> tuple[int, str] | None:
+        try:
+            return file_digest(join(directory, name), uncached)
+        except FileNotFoundError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        found: dict[str, tuple[int, str]] = {
+            name: found_digest for name, found_digest in zip(expected, pool.map(digest, expected))
+            if found_digest is not None
+        }
+
+    return compare_digests(expected, found, directory)
+
+
+def segment_reader(fileobj: BinaryIO, length: int) -> io.BufferedReader:
+    """Read-only view of length bytes of a file, starting where the file is now"""
+    return io.BufferedReader(_Segment(fileobj, length), chunk_size)
+
+
+class _Segment(io.RawIOBase):
+    def __init__(self, fileobj: BinaryIO, length: int):
+        self.fileobj: BinaryIO = fileobj
+        self.remaining: int = length
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data: bytes = self.fileobj.read(min(len(buffer), self.remaining))
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
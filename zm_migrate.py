@@ -0,0 +1,32 @@
+#!/usr/bin/python3
+# One-time migration of the wide zm_sizes table (one column per camera) into the camera_sizes table (one row per
+# camera per date). The old table is kept as zm_sizes_wide, and zm_sizes becomes a view with the old layout so that
+# anything still reading it keeps working. Every script that writes to the database also does this on its own, so
+# running this by hand is optional. Running it twice does nothing.
+import sqlite3
+from admintools import MyLogger
+from zm_db import connect, create_schema, table_type, migrate_wide_table, create_compat_view
+from zm_lib import camera_caches, db_file, db_log_file
+
+
+logger = MyLogger(
+    name='zm_migrate',
+    level=20,
+    to_console=True,
+    to_file=db_log_file
+).logger
+
+con: sqlite3.Connection = connect(db_file)
+create_schema(con)
+
+if table_type(con, 'zm_sizes') == 'table':
+    logger.warning(f'Migrated {migrate_wide_table(con)} camera/date rows from zm_sizes to camera_sizes')
+else:
+    logger.info('zm_sizes is not a wide table. Nothing to migrate.')
+
+create_compat_view(con, camera_caches)
+num_rows: int = con.execute('select count(*) from camera_sizes').fetchone()[0]
+logger.info(f'camera_sizes has {num_rows} rows')
+
+con.close()
+logger.warning('Done\n\n')
@@ -1,58 +1,74 @@
 #!/usr/bin/python3
-import sqlite3
 import pandas as pd
-from admintools import byte_sizer as human_readable
-from matplotlib import pyplot as plt
-from datetime import datetime as dt
-from typing import Callable
-from os.path import islink
+from admintools import MyLogger
+from zm_db import connect, ensure_schema
+from zm_render import RenderJob, render_all
+from os.path import islink, splitext
 from os import listdir
 
 # user defined vars
 db_location: str = '/nfs_share/matt_desktop/server_scripts/zm_helper/zm_size.db'
 save_fig_location: str = '/nfs_share/matt_desktop/server_scripts/zm_helper/figures/zm_monthly_usage.png'
 zm_dir: str = '/var/cache/zoneminder/events'
+output_formats: list[str] = ['png']  # Any of png, svg, json, txt. All are written next to save_fig_location
+figure_dpi: int = 800
+thumbnail_dpi: int | None = 100      # Also write a small _thumb.png of every figure. None to skip
+per_camera_figures: bool = False     # One more figure for every camera
+per_status_figures: bool = False     # One more figure for every status (on_system, on_backup, deleted)
+force_render: bool = False           # Redraw even if the numbers have not changed since the last run
 
-with sqlite3.connect(db_location) as con:
-    df: pd.DataFrame = pd.read_sql('select * from zm_sizes', con)
+logger = MyLogger(
+    name='zm_monthly_usage',
+    level=20,
+    to_console=True
+).logger
 
-# only the last 12 months (current month included)
-year_months: list[str] = df.date.apply(lambda date_str: date_str[:7]).unique()[-13:]
 caches: list[str] = [directory for directory in listdir(zm_dir) if islink(f'{zm_dir}/{directory}')]
-camera_data: list[tuple[str, int]] = []
-
-for year_month in year_months:
-    size: int = 0  # Disk space size for all cameras (aggregated) for each month (individual) 
-    for cache in caches:
-        size += df[df.date.str.startswith(year_month)][cache].sum()
-
-    camera_data.append((year_month, size))
-
-# takes a date like 1990-01 (YYYY-MM) and converts it to Jan '90
-date_formatter: Callable[[str], str] = lambda date: dt.strftime(dt.strptime(date, '%Y-%m'), "%b \'%y")
-terabytes: Callable[[int], int] = lambda i: (i / 1024 ** 4)  # convert int to terabytes
-xy_vals: list[tuple[str, int]] = [(date_formatter(month), terabytes(size)) for month, size in camera_data]
-
-plt.rcParams.update({'font.size': 6})
-plt.subplot(1, 2, 1)
-plt.bar([x for x,y in xy_vals], [y for x,y in xy_vals])
-plt.ylabel('Disk Usage (Terabytes)')
-plt.xticks(rotation=60)
-plt.title('12 Months')
-plt.subplot(1, 2, 2)
-
-cam_data_6mo_ago: list[tuple[str, int, str]] = [
-    (date_formatter(month), terabytes(size), human_readable(size))
-    for month, size in camera_data[-7:]
-]  # the previous six months including the current month
-
-pie_vals: list[int] = [size for _, size, _ in cam_data_6mo_ago]
-pie_labels: list[str] = [f'{hr_size}\n{month}' for month, _, hr_size in cam_data_6mo_ago]
-
-vals_and_labels : list[tuple[str, int]] = [(f'{hr_size}\n{month}', size) for month, size, hr_size in cam_data_6mo_ago]
-
-plt.pie(x=pie_vals, labels=pie_labels)
-plt.title('6 Months')
-plt.suptitle(f"ZoneMinder Monthly Usage -- {dt.now().strftime('%Y-%m-%d')}")  # shows the current date
-plt.savefig(save_fig_location, dpi=800)
-plt.clf()
+
+# Everything every figure needs is loaded at once. camera_rollups already holds one row per month, camera and status
+with connect(db_location) as con:
+    ensure_schema(con, caches)
+    monthly: pd.DataFrame = pd.read_sql(
+        f'''
+        select period as year_month, camera, status, bytes as size
+        from camera_rollups
+        where span = 'month' and camera in ({", ".join("?" for _ in caches)})
+        ''',
+        con,
+        params=caches
+    )
+con.close()
+
+
+def last_12_months(rows: pd.DataFrame) -> list[tuple[str, int]]:
+    """(YYYY-MM, bytes) for the last 12 months (current month included) of the given rows"""
+    totals: pd.Series = rows.groupby('year_month')['size'].sum().sort_index()
+    return [(month, int(size)) for month, size in totals.items()][-13:]
+
+
+def jobs_for(camera_data: list[tuple[str, int]], title: str, suffix: str = '') -> list[RenderJob]:
+    """Every requested output for one figure"""
+    base_name: str = f'{splitext(save_fig_location)[0]}{suffix}'
+    jobs: list[RenderJob] = [
+        RenderJob(camera_data, title, f'{base_name}.{extension}', dpi=figure_dpi, force=force_render)
+        for extension in output_formats
+    ]
+
+    if thumbnail_dpi:
+        jobs.append(RenderJob(camera_data, title, f'{base_name}_thumb.png', dpi=thumbnail_dpi, force=force_render))
+
+    return jobs
+
+
+render_jobs: list[RenderJob] = jobs_for(last_12_months(monthly), 'ZoneMinder Monthly Usage')
+
+if per_camera_figures:
+    for camera, rows in monthly.groupby('camera'):
+        render_jobs += jobs_for(last_12_months(rows), f'ZoneMinder Monthly Usage ({camera})', f'_camera_{camera}')
+
+if per_status_figures:
+    for status, rows in monthly.groupby('status'):
+        render_jobs += jobs_for(last_12_months(rows), f'ZoneMinder Monthly Usage ({status})', f'_status_{status}')
+
+rendered: list[str] = render_all(render_jobs)
+logger.info(f'Rendered {len(rendered)} of {len(render_jobs)} outputs. The rest were already up to date.')
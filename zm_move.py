@@ -2,57 +2,47 @@
 from os import listdir, mkdir
 from os.path import isdir
 from datetime import datetime as dt, timedelta as td
-from admintools import DiskMount, byte_sizer, prune_log
-from threading import Thread
-import pickle
+from typing import Iterator
+from admintools import DiskMount, byte_sizer, prune_log, get_dir_size
 import subprocess
 from time import sleep
-import pandas as pd
-import sqlite3
 from zm_lib import (
     disk_uuid, log_file_name, mount_point, db_file, keep_days, zm_dir, save_dir, logger, ZmHelper,
-    delete_days, max_threads, allow_delete, allow_move, date_fmt, allow_unmount, camera_caches
+    delete_days, max_threads, allow_delete, allow_move, date_fmt, allow_unmount, camera_caches, archive_codec,
+    pipelined, disk_stats_ttl, journal_file, journal_keep_days, throttle
 )
+from zm_scheduler import SpaceLedger
+from zm_db import connect, ensure_schema, SizeIndex
+from zm_journal import JobJournal
+from zm_reaper import trash_root
 
 
-def program_lock(state: bool) -> None:
-    """Lock the program so that it can only be run once at a time. True will lock the program, and False will unlock."""
-    with open(lock_file, 'wb') as file:
-        logger.debug('Unlocking lock file')
-        pickle.dump({'state': state}, file)
+# The journal holds the run lock. Two instances of this program may not run at the same time, but a lock left behind
+# by a run that crashed is taken over, and the jobs that run did not finish are picked up again.
+journal: JobJournal = JobJournal(journal_file)
 
+try:
+    crashed_pid: int | None = journal.acquire()
+except JobJournal.JournalLocked as e:
+    logger.error(f'Program is already running. Wait for it to finish. {e}\n')
+    exit()
 
-zm_helper: ZmHelper = ZmHelper()
+logger.warning(' Beginning Backup '.center(80, '#'))
 
-# Check to see if program is locked
-lock_file: str = f'{zm_dir}/.zm_move.lock'
-try:
-    with open(lock_file, 'rb') as file:
-        lock_state_obj: dict[str, bool] = pickle.load(file)
-except FileNotFoundError:
-    logger.warning('Lock file not found.')
-    lock_state_obj: dict[str, bool] = {'state': False}
+if crashed_pid:
+    logger.warning(f'The previous run (pid {crashed_pid}) did not finish. Its unfinished jobs will be resumed.')
 
-is_locked: bool = lock_state_obj['state']
+logger.debug(f'Forgot {journal.prune(journal_keep_days)} old jobs from {journal_file}')
+zm_helper: ZmHelper = ZmHelper(journal=journal)
 
-if is_locked:
-    # Exit program if already locked. Two instances of this program may not run at the same time.
-    logger.error(f'Program is already running. Wait for finish or delete lock file {lock_file}\n')
-    exit()
-else:
-    # Program is not locked. Lock now.
-    logger.warning(' Beginning Backup '.center(80, '#'))
-    logger.debug('Locking program now.')
-    program_lock(True)
- 
 logger.debug('Creating DiskMount instance')
 
 try:
-    backup_vol: DiskMount = DiskMount(uuid=disk_uuid)
+    backup_vol: DiskMount = DiskMount(uuid=disk_uuid, stats_ttl=disk_stats_ttl)
 except subprocess.CalledProcessError as e:
     logger.critical(e)
     logger.critical(f'Backup disk failed to mount. Perhaps it is disconnected.')
-    program_lock(False)
+    journal.release()
     exit()
 
 try:
@@ -68,6 +58,7 @@ try:
         except DiskMount.DiskMountError:
             logger.critical('Backup disk could not be acquired.')
             logger.critical(backup_vol)
+            journal.release()
             exit()
 except DiskMount.DiskMountError:
     logger.debug('Disk is not already mounted')
@@ -82,6 +73,7 @@ if backup_vol.is_mounted:
     logger.warning(f'Backup disk is at {backup_vol.disk_usage()}%')
 else:
     logger.error('Backup disk was not mounted properly. Exiting now.')
+    journal.release()
     exit()
 
 start: dt = dt.now()
@@ -90,16 +82,79 @@ if not isdir(save_dir):
     logger.warning(f'{save_dir} does not exist. Creating now.')
     mkdir(save_dir)
 
-# Delete old saves in save_dir (older than delete_days)
-time_threshold: dt = dt.now() - td(days=delete_days)
+# Sources on the camera disks are trashed too (when an archive is resumed), so every filesystem has a trash to check
+trashes: set[str] = {trash_root(path) for path in [save_dir] + [f'{zm_dir}/{cache}' for cache in camera_caches]}
+num_leftovers: int = sum(zm_helper.reaper.reap_leftovers(trash) for trash in sorted(trashes))
+if num_leftovers:
+    logger.warning(f'Deleting {num_leftovers} directories left in the trash by an earlier run')
+
+delete_threshold: dt = dt.now() - td(days=delete_days)  # Delete old saves in save_dir (older than delete_days)
+archive_threshold: dt = dt.now() - td(days=keep_days)   # Archive videos on the system older than keep_days
+archive_threshold_formatted: str = dt.strftime(archive_threshold, date_fmt)  # Date formatted as YYYY-MM-DD
+
+
+def find_delete_targets() -> Iterator[tuple[str, int]]:
+    """Directories on the backup disk that are older than delete_days. Yields (path, size)"""
+    for cache in listdir(save_dir):
+        cache_dir: str = f'{save_dir}/{cache}'
+
+        for date_dir in listdir(cache_dir):
+            try:
+                date_dir_parsed: dt = dt.strptime(date_dir, '%Y-%m-%d')
+            except ValueError:
+                logger.error(f'Invalid date dir -- {date_dir} in {cache_dir}')
+                continue
+
+            if date_dir_parsed < delete_threshold:
+                target: str = f'{cache_dir}/{date_dir}'
+                # The space deleting it really frees, which is what the ledger hands to archives. A backup day is a few
+                # archives, so this is quick. The size in the database is that of the footage before it was archived.
+                size: int = get_dir_size(target, apparent=False)
+                yield target, size
+
+
+def find_archive_targets() -> Iterator[tuple[str, str, int, str, str]]:
+    """Directories on the system that are older than keep_days. Yields (source, destination, size, cache, date)"""
+    num_jobs: int = 0
+
+    # Each camera has its own data cache
+    for cache in camera_caches:
+        # Each cache has directories named by the date they were created
+        dates_cache: list[str] = listdir(f'{zm_dir}/{cache}')
+
+        for date_dir in dates_cache:
+            try:
+                cache_date_parsed: dt = dt.strptime(date_dir, date_fmt)  # Convert dir name into datetime object
+            except ValueError:
+                logger.warning(f'Invalid date folder found {zm_dir}/{cache}/{date_dir}. This should be deleted!')
+                continue
+
+            if cache_date_parsed < archive_threshold:
+                source: str = f'{zm_dir}/{cache}/{date_dir}'
+                destination: str = f'{save_dir}/{cache}/{date_dir}'
+
+                if num_jobs < max_threads:  # Put a limit on how many jobs can be done per day
+                    logger.debug(f'Found copy path {source}')
+                    size: int = size_index.get(cache, date_dir, path=source)
+                    num_jobs += 1
+                    yield source, destination, size, cache, date_dir
+                else:
+                    logger.warning(f'Maximum of {max_threads} move jobs reached for the day.')
+                    return
+
+
 if allow_delete:
-    logger.info(f"Searching {save_dir} for save_dir older than {time_threshold.strftime('%Y-%m-%d')} to delete.")
+    logger.info(f"Searching {save_dir} for save_dir older than {delete_threshold.strftime('%Y-%m-%d')} to delete.")
 
 
-with sqlite3.connect(db_file) as con:
-    df = pd.read_sql('select * from zm_sizes', con)
+# Only the sizes that can be scheduled today are loaded: camera dates older than the archive threshold
+with connect(db_file) as con:
+    ensure_schema(con, camera_caches)  # a database with only the old wide zm_sizes table is migrated first
+    size_index: SizeIndex = SizeIndex(con, caches=camera_caches, before=dt.strftime(archive_threshold, date_fmt))
+con.close()
 
 delete_size: int = 0
+backup_size: int = 0
 
 dry_run: bool = False
 if not allow_move and not allow_delete:
@@ -108,125 +163,147 @@ if not allow_move and not allow_delete:
                    'Changes will be recorded in the log, but no actual changes will be made.')
     dry_run: bool = True
 
-# Begin scheduling threads
-for cache in listdir(save_dir):
-    cache_dir: str = f'{save_dir}/{cache}'
+disk_used_start: int = backup_vol.disk_used()  # How much space is currently being used on partition
+disk_usage_start: int = backup_vol.disk_usage()  # Same as above - but as a percentage
 
-    for date_dir in listdir(cache_dir):
-        try:
-            date_dir_parsed: dt = dt.strptime(date_dir, '%Y-%m-%d')
-        except ValueError:
-            logger.error(f'Invalid date dir -- {date_dir} in {cache_dir}')
+if pipelined:
+    # Deletes and archives run side by side. Jobs are handed to the scheduler as soon as they are found, and each
+    # archive starts as soon as enough deletes have finished to make room for it on the backup disk.
+    ledger: SpaceLedger = SpaceLedger(available=backup_vol.disk_available())
+    resumed: set[str] = zm_helper.resume(ledger=ledger)
+    zm_helper.run()
+
+    for target, size in find_delete_targets():
+        if target in resumed:
             continue
 
-        if date_dir_parsed < time_threshold:
-            target: str = f'{cache_dir}/{date_dir}'
-            size: int = df[df.date == date_dir][cache].item()
-            delete_size += size
+        delete_size += size
 
-            thread: Thread = Thread(
-                target=zm_helper.delete_worker,
-                args=(target, size)
-            )
-            zm_helper.delete_threads.append(thread)
+        if allow_delete:
+            zm_helper.submit_delete(target, size, ledger=ledger)
 
+    ledger.close()  # every delete has been scheduled. Archives that still do not fit can give up.
 
-disk_availability_human_readable: str = byte_sizer(backup_vol.disk_available())  # Space available on partition
-disk_used_start: int = backup_vol.disk_used()  # How much space is currently being used on partition
-disk_usage_start: int = backup_vol.disk_usage()  # Same as above - but as a percentage
-delete_size_human_readable: str = byte_sizer(delete_size)
+    if not allow_delete:
+        logger.info('Deletion disabled. No changes made.')
 
-logger.info(f'''        
-               Delete Job
-    Available space: {disk_availability_human_readable}
-         Disk Usage: {disk_usage_start}%
-        Delete Size: {delete_size_human_readable}
-        Num threads: {len(zm_helper.delete_threads)}
-    ''')
+    logger.info(f'Searching for directories {zm_dir} older than {archive_threshold_formatted} to archive')
 
-if allow_delete:
-    [thread.start() for thread in zm_helper.delete_threads]
-    [thread.join()  for thread in zm_helper.delete_threads]
-else:
-    logger.info('Deletion disabled. No changes made.')
+    for source, destination, size, cache, date_dir in find_archive_targets():
+        if source in resumed:
+            continue
 
+        backup_size += size
 
-# Begin move jobs
-logger.info('Finished delete threads. Beginning move threads now.')
-limit_reached: bool = False
-time_threshold: dt = dt.now() - td(days=keep_days)
-time_threshold_formatted: str = dt.strftime(time_threshold, date_fmt)  # Date formatted as YYYY-MM-DD
-backup_size: int = 0
+        if allow_move:
+            zm_helper.submit_archive(source, destination, size, cache, date_dir, archive_codec, ledger=ledger)
+
+    if not allow_move:
+        logger.warning('Move to backup is not allowed. No changes made')
 
-logger.info(f'Searching for directories {zm_dir} older than {time_threshold_formatted} to archive')
+    logger.info(f'''
+              Pipelined Job
+        Delete Size: {byte_sizer(delete_size)}
+        Backup Size: {byte_sizer(backup_size)}
+        Delete Jobs: {len(zm_helper.delete_jobs)}
+        Backup Jobs: {len(zm_helper.archive_jobs)}
+    ''')
 
-# Each camera has its own data cache
-for cache in camera_caches:
-    # Each cache has directories named by the date they were created
-    dates_cache: list[str] = listdir(f'{zm_dir}/{cache}')
+    zm_helper.scheduler.wait(zm_helper.delete_jobs + zm_helper.archive_jobs)  # Program waits here for all jobs
+    status: str = 'Failure' if any(job.exception() for job in zm_helper.archive_jobs) else 'Success'
 
-    for date_dir in dates_cache:
-        if limit_reached:
-            break
+else:
+    # Resumed jobs run right away, whatever is allowed below. Resumed archives, the deletes and the batch of new
+    # archives all take their room on the backup disk from one ledger, so together they never promise more than it has
+    ledger: SpaceLedger = SpaceLedger(available=backup_vol.disk_available())
+    resumed: set[str] = zm_helper.resume(ledger=ledger)
+    zm_helper.run()
+    delete_targets: list[tuple[str, int]] = [
+        (target, size) for target, size in find_delete_targets() if target not in resumed
+    ]  # (path, size)
+    delete_size: int = sum(size for _, size in delete_targets)
+
+    logger.info(f'''
+                   Delete Job
+        Available space: {byte_sizer(backup_vol.disk_available())}
+             Disk Usage: {disk_usage_start}%
+            Delete Size: {byte_sizer(delete_size)}
+               Num jobs: {len(delete_targets)}
+        ''')
+
+    if allow_delete:
+        for target, size in delete_targets:
+            zm_helper.submit_delete(target, size, ledger=ledger)
+
+        ledger.close()  # every delete has been scheduled
+        zm_helper.run()
+        zm_helper.scheduler.wait(zm_helper.delete_jobs)
+        zm_helper.reaper.join()  # the space is only free once the trash has been deleted
+        backup_vol.invalidate()  # the deletes changed the free space
+    else:
+        ledger.close()
+        logger.info('Deletion disabled. No changes made.')
+
+    # Begin move jobs
+    logger.info('Finished delete jobs. Beginning move jobs now.')
+    logger.info(f'Searching for directories {zm_dir} older than {archive_threshold_formatted} to archive')
+
+    archive_targets: list[tuple[str, str, int, str, str]] = [
+        target for target in find_archive_targets() if target[0] not in resumed
+    ]
+    backup_size: int = sum(size for _, _, size, _, _ in archive_targets)
+    disk_availability_start: int = backup_vol.disk_available()
+
+    logger.info(f'''
+                     Move Job
+            Backup size: {byte_sizer(backup_size)}
+        Available space: {byte_sizer(disk_availability_start)}
+             Disk Usage: {backup_vol.disk_usage()}%
+               Num jobs: {len(archive_targets)}
+               Max jobs: {max_threads}
+        ''')
+
+    if allow_move:
+        # check to see if the backup disk has enough space to handle the backup jobs, besides the resumed ones
+        if ledger.reserve(backup_size):
+            status: str = 'Success'
+            # Begin jobs
+            # The scheduler is already running, so queue the biggest jobs first
+            for source, destination, size, cache, date_dir in sorted(archive_targets, key=lambda job: -job[2]):
+                zm_helper.submit_archive(source, destination, size, cache, date_dir, archive_codec)
+
+            zm_helper.run()
+            zm_helper.scheduler.wait(zm_helper.archive_jobs)  # Program waits here for all jobs to complete
+
+            if any(job.exception() for job in zm_helper.archive_jobs):
+                status: str = 'Failure'
         else:
-            try:
-                cache_date_parsed: dt = dt.strptime(date_dir, date_fmt)  # Convert dir name into datetime object
-            except ValueError:
-                logger.warning(f'Invalid date folder found {zm_dir}/{cache}/{date_dir}. This should be deleted!')
-                continue
+            logger.error('The backup disk does not have enough space for the current set of jobs! Skipping!')
+            status: str = 'Failure'
+    else:
+        logger.warning('Move to backup is not allowed. No changes made')
+        status: str = 'Success'
 
-            if cache_date_parsed < time_threshold:
-                source: str = f'{zm_dir}/{cache}/{date_dir}'
-                destination: str = f'{save_dir}/{cache}/{date_dir}'
 
-                if len(zm_helper.archive_threads) < max_threads:  # Put a limit on how many jobs can be done per day
-                    logger.debug(f'Found copy path {source}')
-                    size: int = df[df.date == date_dir][cache].item()
-                    backup_size += size
-
-                    # archive_worker and move_worker will have the same args
-                    thread: Thread = Thread(
-                        target=zm_helper.archive_worker,
-                        args=(source, destination, size, cache, date_dir, 'bztar')
-                    )
-                    zm_helper.archive_threads.append(thread)
-                else:
-                    logger.warning(f'Maximum of {max_threads} move jobs reached for the day.')
-                    limit_reached: bool = True
+if throttle.lowest_limit < throttle.max_slots:
+    logger.warning(f'The camera disks were busy. Jobs were throttled down to {throttle.lowest_limit} of '
+                   f'{throttle.max_slots} slots (target latency {throttle.target_latency_ms} ms)')
 
+if size_index.misses:
+    logger.warning(f'{size_index.misses} directories were missing from {db_file} and had to be sized from disk')
 
-disk_availability_end: int = backup_vol.disk_available()
 backup_size_human_readable: str = byte_sizer(backup_size)
-disk_availability_human_readable: str = byte_sizer(disk_availability_end)
-
-logger.info(f'''
-                 Move Job
-        Backup size: {backup_size_human_readable}
-    Available space: {disk_availability_human_readable}
-         Disk Usage: {backup_vol.disk_usage()}%
-        Num threads: {len(zm_helper.archive_threads)}
-        Max threads: {max_threads}
-    ''')
-
-if allow_move:
-    # check to see if the backup disk has enough space to handle the backup jobs
-    if disk_availability_end > backup_size:
-        status: str = 'Success'
-        # Begin threads
-        [thread.start() for thread in zm_helper.archive_threads]
-        [thread.join()  for thread in zm_helper.archive_threads]  # Program waits here for all threads to complete
-    else:
-        logger.error('The backup disk does not have enough space for the current set of jobs! Skipping!')
-        status: str = 'Failure'
-else:
-    logger.warning('Move to backup is not allowed. No changes made')
-    status: str = 'Success'
-
+delete_size_human_readable: str = byte_sizer(delete_size)
 
-program_lock(False)  # Program finished. Unlock to allow new instances in the future.
+zm_helper.scheduler.shutdown()
+zm_helper.reaper.shutdown()  # waits for the trash to be deleted
+backup_vol.invalidate()  # every job has written to the disk by now
+journal.release()  # Program finished. Unlock to allow new instances in the future.
+journal.close()
 disk_used_end: int = backup_vol.disk_used()  # hom much disk space is being used currently
 disk_usage_end: int = backup_vol.disk_usage()  # percentage of how much disk space is being used currently
 disk_size: int = backup_vol.disk_size()  # total size of disk partition
+disk_availability_end: int = backup_vol.disk_available()  # space left on the partition once finished
 disk_change: int = disk_used_end - disk_used_start  # how much data was added to disk once finished
 disk_usage_pcent: int = disk_usage_end - disk_usage_start  # disk change as a percentage
 
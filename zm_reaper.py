@@ -0,0 +1,136 @@
+import errno
+from os import rename, makedirs, scandir, unlink, rmdir, open as os_open, close, O_RDONLY, O_DIRECTORY
+from os.path import realpath, dirname, basename, ismount, join, isdir
+from time import time_ns
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from contextlib import nullcontext
+from zm_throttle import Throttle
+
+
+def trash_root(path: str) -> str:
+    """The trash directory for a path: .zm_trash at the top of the filesystem it is on, so moving into it is a rename"""
+    mount: str = realpath(path)
+
+    while not ismount(mount):
+        mount = dirname(mount)
+
+    return join(mount, '.zm_trash')
+
+
+def reap_tree(path: str, pool: ThreadPoolExecutor, batch_size: int = 512, throttle: Throttle | None = None) -> int:
+    """
+    Delete a directory tree. The tree is walked once with scandir, the files are unlinked relative to their directory
+    (unlinkat) in batches on the pool, and the emptied directories are removed last. Each batch goes through the
+    throttle, if there is one. Returns the number of files.
+    """
+    directories: list[str] = []
+    batches: list[Future] = []
+    stack: list[str] = [path]
+    num_files: int = 0
+
+    while stack:
+        directory: str = stack.pop()
+        directories.append(directory)
+        names: list[str] = []
+
+        with scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    names.append(entry.name)
+
+        num_files += len(names)
+
+        for i in range(0, len(names), batch_size):
+            batches.append(pool.submit(_unlink_batch, directory, names[i:i + batch_size], throttle))
+
+    for batch in batches:
+        batch.result()  # raises the first error
+
+    for directory in reversed(directories):  # children were found after their parents
+        rmdir(directory)
+
+    return num_files
+
+
+def _unlink_batch(directory: str, names: list[str], throttle: Throttle | None = None) -> None:
+    with throttle.io() if throttle else nullcontext():
+        dir_fd: int = os_open(directory, O_RDONLY | O_DIRECTORY)
+
+        try:
+            for name in names:
+                try:
+                    unlink(name, dir_fd=dir_fd)
+                except FileNotFoundError:
+                    pass
+        finally:
+            close(dir_fd)
+
+
+class Reaper:
+    """
+    Two step delete. trash() renames a directory into the trash of its filesystem, which takes the same time no matter
+    how many frames are in it, so the delete job is over at once. The trashed trees are then deleted in the background,
+    one at a time, with their files unlinked on a pool of its own. The reaper never takes a scheduler slot.
+    """
+
+    def __init__(self, workers: int = 4, batch_size: int = 512, throttle: Throttle | None = None):
+        self.batch_size: int = batch_size
+        self.throttle: Throttle | None = throttle
+        self.walker: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='reaper')
+        self.pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='reaper_unlink')
+        self.pending: list[Future] = []
+        self.lock: Lock = Lock()  # trash() is called from the scheduler threads
+
+    def trash(self, path: str) -> Future:
+        """
+        Move a directory into the trash and schedule it to be deleted. The path is gone when this returns. The returned
+        future holds the number of files once the space has really been freed.
+        """
+        trash: str = trash_root(dirname(path))
+        trashed: str = join(trash, f'{time_ns()}_{basename(path)}')
+
+        try:
+            makedirs(trash, exist_ok=True)
+            rename(path, trashed)
+        except OSError as error:
+            if error.errno not in (errno.EXDEV, errno.EACCES, errno.EPERM, errno.EROFS):
+                raise
+            trashed = path  # the trash can not be used here. Delete it where it is
+
+        return self._reap(trashed)
+
+    def reap_leftovers(self, trash: str) -> int:
+        """Schedule whatever a run that died left in a trash directory. Returns how many trees were found."""
+        if not isdir(trash):
+            return 0
+
+        with scandir(trash) as entries:
+            leftovers: list[str] = [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]
+
+        for leftover in leftovers:
+            self._reap(leftover)
+
+        return len(leftovers)
+
+    def join(self) -> None:
+        """Wait until everything trashed so far has been deleted"""
+        with self.lock:
+            pending: list[Future] = list(self.pending)
+
+        wait(pending)
+
+    def shutdown(self) -> None:
+        self.join()
+        self.walker.shutdown()
+        self.pool.shutdown()
+
+    def _reap(self, path: str) -> Future:
+        future: Future = self.walker.submit(reap_tree, path, self.pool, self.batch_size, self.throttle)
+
+        with self.lock:
+            self.pending = [job for job in self.pending if not job.done()] + [future]
+
+        return future
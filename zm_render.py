@@ -0,0 +1,121 @@
+import json
+import hashlib
+import matplotlib
+matplotlib.use('Agg')  # headless backend. This has to happen before pyplot is imported
+from matplotlib import pyplot as plt
+from admintools import byte_sizer as human_readable
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime as dt
+from os.path import isfile, splitext
+from typing import Callable
+
+
+# takes a date like 1990-01 (YYYY-MM) and converts it to Jan '90
+date_formatter: Callable[[str], str] = lambda date: dt.strftime(dt.strptime(date, '%Y-%m'), "%b \'%y")
+terabytes: Callable[[int], float] = lambda i: (i / 1024 ** 4)  # convert int to terabytes
+
+
+class RenderJob:
+    """
+    One output file of the usage report. The extension of path decides the output: .png or .svg for a figure, .json
+    or .txt for a plain summary without matplotlib. camera_data is a list of (YYYY-MM, bytes) for the last 12 months.
+    The render date is left out of the fingerprint, so a figure is only redrawn when its numbers change.
+    """
+
+    def __init__(self, camera_data: list[tuple[str, int]], title: str, path: str, dpi: int = 800, force: bool = False):
+        self.camera_data: list[tuple[str, int]] = [(month, int(size)) for month, size in camera_data]
+        self.title: str = title
+        self.path: str = path
+        self.dpi: int = dpi
+        self.force: bool = force  # render even if the data has not changed
+
+    def fingerprint(self) -> str:
+        """Hash of everything that ends up in the output. If it matches the last render, the file is up to date."""
+        payload: str = json.dumps([self.camera_data, self.title, self.dpi])
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def fingerprint_file(self) -> str:
+        return f'{self.path}.fingerprint'
+
+    def is_current(self) -> bool:
+        if self.force or not isfile(self.path) or not isfile(self.fingerprint_file()):
+            return False
+
+        with open(self.fingerprint_file(), 'r') as fh:
+            return fh.read().strip() == self.fingerprint()
+
+
+def render(job: RenderJob) -> str | None:
+    """Write one output file. Returns its path, or None if it was already up to date and was skipped."""
+    if job.is_current():
+        return None
+
+    extension: str = splitext(job.path)[1].lower()
+
+    if extension in ('.json', '.txt'):
+        write_summary(job)
+    else:
+        plot_usage(job)
+
+    with open(job.fingerprint_file(), 'w') as fh:
+        fh.write(job.fingerprint())
+
+    return job.path
+
+
+def render_all(jobs: list[RenderJob], processes: int | None = None) -> list[str]:
+    """Render every job that is out of date, each in its own process. Returns the paths that were written."""
+    stale_jobs: list[RenderJob] = [job for job in jobs if not job.is_current()]
+
+    if len(stale_jobs) <= 1:
+        return [path for path in map(render, stale_jobs) if path]
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return [path for path in pool.map(render, stale_jobs) if path]
+
+
+def plot_usage(job: RenderJob) -> None:
+    """Bar chart of the last 12 months next to a pie chart of the last 6"""
+    xy_vals: list[tuple[str, float]] = [(date_formatter(month), terabytes(size)) for month, size in job.camera_data]
+
+    plt.rcParams.update({'font.size': 6})
+    figure: plt.Figure = plt.figure()
+    plt.subplot(1, 2, 1)
+    plt.bar([x for x, y in xy_vals], [y for x, y in xy_vals])
+    plt.ylabel('Disk Usage (Terabytes)')
+    plt.xticks(rotation=60)
+    plt.title('12 Months')
+    plt.subplot(1, 2, 2)
+
+    cam_data_6mo_ago: list[tuple[str, float, str]] = [
+        (date_formatter(month), terabytes(size), human_readable(size))
+        for month, size in job.camera_data[-7:]
+    ]  # the previous six months including the current month
+
+    pie_vals: list[float] = [size for _, size, _ in cam_data_6mo_ago]
+    pie_labels: list[str] = [f'{hr_size}\n{month}' for month, _, hr_size in cam_data_6mo_ago]
+
+    plt.pie(x=pie_vals, labels=pie_labels)
+    plt.title('6 Months')
+    plt.suptitle(f"{job.title} -- {dt.now().strftime('%Y-%m-%d')}")  # shows the date it was rendered
+    plt.savefig(job.path, dpi=job.dpi)
+    plt.close(figure)
+
+
+def write_summary(job: RenderJob) -> None:
+    """The same numbers as the figure, as json or as a plain text table"""
+    if job.path.lower().endswith('.json'):
+        summary: dict = {
+            'title': job.title,
+            'months': [
+                {'month': month, 'bytes': size, 'size': human_readable(size)} for month, size in job.camera_data
+            ],
+        }
+        with open(job.path, 'w') as fh:
+            json.dump(summary, fh, indent=2)
+    else:
+        lines: list[str] = [job.title, ''] + [
+            f'{date_formatter(month):>8}  {human_readable(size):>12}' for month, size in job.camera_data
+        ]
+        with open(job.path, 'w') as fh:
+            fh.write('\n'.join(lines) + '\n')
@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+# Restore footage from the archives on the backup disk. The backup disk has to be mounted.
+#
+# Single events, or every event in a time range, go to restore_dir (or --to). Archives written with archive_index =
+# True have an index next to them that says where every event starts, so only the blocks of the wanted events are read.
+#
+#   $ zm_restore.py CAMERA --event 123456 --event 123457
+#   $ zm_restore.py CAMERA --start '2024-05-01 13:00' --end '2024-05-01 14:30'
+#
+# Whole camera-days go back into zm_dir (or --to, as a staging directory), and are marked on_system in the database
+# when they went to zm_dir. Keep in mind that zm_move.py archives days older than keep_days again, so use a staging
+# directory for anything that should stay around for longer.
+#
+#   $ zm_restore.py CAMERA [CAMERA ...] --day 2024-05-01 --day 2024-05-03
+#   $ zm_restore.py CAMERA [CAMERA ...] --first-day 2024-04-01 --last-day 2024-04-30
+#
+# Many archives (and the events of indexed archives) are extracted at once, restore_workers at a time. Extraction goes
+# through the same throttle as zm_move.py, so ZoneMinder keeps priority on the camera disks.
+import argparse
+import sqlite3
+from os import listdir, stat, chown, stat_result
+from os.path import isdir, isfile
+from datetime import datetime as dt, timedelta as td
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable
+from zm_archive import archive_errors, codecs, read_index, extract_event, extract_archive, index_path
+from zm_db import connect, ensure_schema, set_status
+from zm_lib import (
+    save_dir, restore_dir, zm_dir, date_fmt, logger, db_file, camera_caches, restore_workers, throttle
+)
+
+
+def find_archives(camera: str) -> list[tuple[str, str]]:
+    """Archives of a camera on the backup disk, oldest first. Returns [(date, archive path)]."""
+    camera_dir: str = f'{save_dir}/{camera}'
+    extensions: tuple[str, ...] = tuple(f'.{codec.extension}' for codec in codecs.values())
+    archives: list[tuple[str, str]] = []
+
+    if not isdir(camera_dir):
+        logger.error(f'{camera_dir} does not exist')
+        return archives
+
+    for date in sorted(listdir(camera_dir)):
+        date_dir: str = f'{camera_dir}/{date}'
+
+        if isdir(date_dir):
+            archives += [
+                (date, f'{date_dir}/{name}') for name in sorted(listdir(date_dir)) if name.endswith(extensions)
+            ]
+
+    return archives
+
+
+def parse_time(value: str) -> dt:
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', date_fmt):
+        try:
+            return dt.strptime(value, fmt)
+        except ValueError:
+            continue
+
+    raise argparse.ArgumentTypeError(f'{value} is not a time like YYYY-MM-DD HH:MM')
+
+
+def event_jobs(camera: str, destination: str) -> list[tuple[str, str, str, Callable[[], int]]]:
+    """One job per wanted event, from the indexed archives. Returns [(camera, date, event, job)]"""
+    archives: list[tuple[str, str]] = find_archives(camera)
+
+    if not args.event:
+        # Only the days in the range. An event is filed under the day it started, so the day before is searched too.
+        if args.start:
+            archives = [(date, archive) for date, archive in archives
+                        if date >= dt.strftime(args.start - td(days=1), date_fmt)]
+        if args.end:
+            archives = [(date, archive) for date, archive in archives if date <= dt.strftime(args.end, date_fmt)]
+
+    start_time: float = args.start.timestamp() if args.start else float('-inf')
+    end_time: float = args.end.timestamp() if args.end else float('inf')
+    jobs: list[tuple[str, str, str, Callable[[], int]]] = []
+
+    for date, archive in archives:
+        if not isfile(index_path(archive)):
+            logger.debug(f'{archive} has no index. Skipping')
+            continue
+
+        archive_index: dict = read_index(archive)
+        day_dir: str = f'{destination}/{camera}/{date}'
+
+        for event, entry in archive_index['events'].items():
+            if event == '.':
+                continue
+
+            if args.event:
+                if event not in args.event:
+                    continue
+            elif entry['first'] is None or entry['last'] < start_time or entry['first'] > end_time:
+                continue
+
+            jobs.append((camera, date, event, lambda archive=archive, event=event, index=archive_index, day_dir=day_dir:
+                         extract_event(archive, event, day_dir, index, throttle, keep_owner)))
+
+    return jobs
+
+
+def day_jobs(camera: str, destination: str) -> list[tuple[str, str, str, Callable[[], int]]]:
+    """
+    Jobs that restore whole days. An indexed archive is split into one job per event, so even a single day is
+    decompressed on several cores. Returns [(camera, date, event or '*', job)]
+    """
+    jobs: list[tuple[str, str, str, Callable[[], int]]] = []
+
+    for date, archive in find_archives(camera):
+        if args.day and date not in args.day:
+            continue
+        if (args.first_day and date < args.first_day) or (args.last_day and date > args.last_day):
+            continue
+
+        day_dir: str = f'{destination}/{camera}/{date}'
+
+        if isfile(index_path(archive)):
+            archive_index: dict = read_index(archive)
+            jobs += [
+                (camera, date, event, lambda archive=archive, event=event, index=archive_index, day_dir=day_dir:
+                 extract_event(archive, event, day_dir, index, throttle, keep_owner))
+                for event in archive_index['events']
+            ]
+        else:
+            jobs.append((camera, date, '*', lambda archive=archive, day_dir=day_dir:
+                         extract_archive(archive, day_dir, throttle, keep_owner)))
+
+    return jobs
+
+
+parser: argparse.ArgumentParser = argparse.ArgumentParser(description='Restore footage from the backup archives')
+parser.add_argument('cameras', nargs='+', help='camera cache names, as in camera_caches')
+parser.add_argument('--event', action='append', default=[], help='event id to restore. Can be given more than once')
+parser.add_argument('--start', type=parse_time, help='restore every event with footage after this time')
+parser.add_argument('--end', type=parse_time, help='restore every event with footage before this time')
+parser.add_argument('--day', action='append', default=[], help='whole day (YYYY-MM-DD) to restore. Can be repeated')
+parser.add_argument('--first-day', help='restore every whole day from this one (YYYY-MM-DD)')
+parser.add_argument('--last-day', help='restore every whole day up to this one (YYYY-MM-DD)')
+parser.add_argument('--to', help=f'where to restore to (default {restore_dir} for events, {zm_dir} for days)')
+parser.add_argument('--workers', type=int, default=restore_workers, help='archives/events to extract at once')
+args: argparse.Namespace = parser.parse_args()
+
+restore_events: bool = bool(args.event or args.start or args.end)
+restore_days: bool = bool(args.day or args.first_day or args.last_day)
+
+if restore_events == restore_days:
+    parser.error('give either events (--event, --start/--end) or days (--day, --first-day/--last-day)')
+
+destination: str = args.to or (restore_dir if restore_events else zm_dir)
+keep_owner: bool = destination == zm_dir  # ZoneMinder has to be able to purge what goes back into zm_dir
+jobs: list[tuple[str, str, str, Callable[[], int]]] = []
+
+for camera in args.cameras:
+    jobs += event_jobs(camera, destination) if restore_events else day_jobs(camera, destination)
+
+logger.warning(f'Restoring {len(jobs)} {"events" if restore_events else "archive pieces"} to {destination}')
+started: dt = dt.now()
+failed_days: set[tuple[str, str]] = set()
+num_files: int = 0
+
+with ThreadPoolExecutor(max_workers=args.workers) as pool:
+    futures: list[tuple[str, str, str, Future]] = [
+        (camera, date, event, pool.submit(job)) for camera, date, event, job in jobs
+    ]
+
+    for camera, date, event, future in futures:
+        try:
+            num_files += future.result()
+            logger.debug(f'Restored {camera} {date} event {event}')
+        except archive_errors as e:  # one damaged archive only fails its own day
+            failed_days.add((camera, date))
+            logger.error(f'Restore failed {camera} {date} event {event} -- {e!r}')
+
+restored_days: list[tuple[str, str]] = sorted({(camera, date) for camera, date, _, _ in jobs} - failed_days)
+
+if restore_events:
+    missing: set[str] = set(args.event) - {event for _, _, event, _ in jobs}
+
+    if missing:
+        logger.error(f'Not found in the indexed archives of {", ".join(args.cameras)}: {", ".join(sorted(missing))}')
+elif destination == zm_dir and restored_days:
+    for camera, date in restored_days:
+        # The files kept their owner. The day directory was made by us, so it goes to the owner of the camera directory
+        owner: stat_result = stat(f'{zm_dir}/{camera}')
+        chown(f'{zm_dir}/{camera}/{date}', owner.st_uid, owner.st_gid)
+
+    con: sqlite3.Connection = connect(db_file)
+    ensure_schema(con, camera_caches)
+
+    with con:
+        set_status(con, restored_days, 'on_system', zm_dir)
+
+    con.close()
+    logger.info(f'Marked {len(restored_days)} camera-days on_system in {db_file}')
+
+logger.warning(f'Restored {num_files} files of {len(restored_days)} camera-days to {destination} in '
+               f'{dt.now() - started}. {len(failed_days)} camera-days failed.')
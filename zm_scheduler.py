@@ -0,0 +1,203 @@
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from itertools import count
+from queue import PriorityQueue
+from threading import Thread, Lock, Condition
+from typing import Callable, Any, Iterable
+
+
+class JobSkipped(Exception):
+    def __init__(self, message='Job was skipped'):
+        self.message: str = message
+        super().__init__(self.message)
+
+
+class Job:
+    """One unit of work for the JobScheduler"""
+    _sequence = count()
+
+    def __init__(self, func: Callable[..., Any], args: tuple, size: int = 0, kind: str = 'io', name: str = '',
+                 gate: Callable[[], bool] | None = None):
+        self.func: Callable[..., Any] = func
+        self.args: tuple = args
+        self.size: int = size
+        self.kind: str = kind  # 'io' or 'cpu'. Decides which pool runs the job
+        self.name: str = name
+        self.gate: Callable[[], bool] | None = gate  # runs in the worker thread just before func. False skips the job
+        self.future: Future = Future()
+        self.sequence: int = next(self._sequence)
+
+    def priority(self) -> tuple[int, int, int]:
+        """
+        Queue order. Jobs run largest-first so that the biggest directories are started early and the small ones fill
+        in the gaps at the end of the run (less time waiting on one straggler). Equal sizes keep the order they were
+        submitted in.
+        """
+        return 0, -self.size, self.sequence
+
+    def __repr__(self):
+        return f'Job({self.kind}, {self.name or self.func.__name__}, {self.size})'
+
+
+class JobScheduler:
+    """
+    A bounded worker pool with a work queue for each kind of job. I/O-bound jobs (deletes, moves) and cpu-bound jobs
+    (archives) get separate pools so that a long compression job can never hold up a cheap delete. Every submitted job
+    gets a Future back.
+
+    The cpu pool can run on threads (default) or on processes. When running on processes the job function and its args
+    must be picklable. Jobs wait in the queue until start() is called, so a whole batch can be queued up first and then
+    run largest-first.
+    """
+
+    def __init__(self, io_workers: int = 5, cpu_workers: int = 2, cpu_pool_type: str = 'thread'):
+        if cpu_pool_type not in ('thread', 'process'):
+            raise ValueError(f'cpu_pool_type must be thread or process, not {cpu_pool_type}')
+
+        self.workers: dict[str, int] = {'io': io_workers, 'cpu': cpu_workers}
+        self.queues: dict[str, PriorityQueue] = {kind: PriorityQueue() for kind in self.workers}
+        self.process_pool: ProcessPoolExecutor | None = (
+            ProcessPoolExecutor(max_workers=cpu_workers) if cpu_pool_type == 'process' else None
+        )
+        self.threads: list[Thread] = []
+        self.lock: Lock = Lock()
+        self.counters: dict[str, int] = {}  # use increment(). Never write to this directly
+        self.results: list[tuple[Job, Any]] = []  # (job, return value) of every job that finished without error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def submit(self, func: Callable[..., Any], *args, size: int = 0, kind: str = 'io', name: str = '',
+               gate: Callable[[], bool] | None = None) -> Future:
+        """
+        Put a job on the queue. The returned future holds the return value (or the exception) of func(*args). If a gate
+        is given it is called in the main process right before the job runs and may block. When it returns False the
+        job is skipped and its future raises JobSkipped.
+        """
+        if kind not in self.queues:
+            raise ValueError(f'kind must be one of {", ".join(self.queues)}, not {kind}')
+
+        job: Job = Job(func, args, size=size, kind=kind, name=name, gate=gate)
+        self.increment(f'{kind}_submitted')
+        self.queues[kind].put((*job.priority(), job))
+
+        return job.future
+
+    def start(self) -> None:
+        """Start the worker threads. Calling this more than once does nothing."""
+        with self.lock:
+            if self.threads:
+                return
+
+            for kind, num_workers in self.workers.items():
+                for num in range(num_workers):
+                    thread: Thread = Thread(target=self._worker, args=(kind,), name=f'zm_{kind}_{num}', daemon=True)
+                    self.threads.append(thread)
+                    thread.start()
+
+    def shutdown(self, wait_for_jobs: bool = True) -> None:
+        """Let the workers finish what is queued, then stop them"""
+        for kind, num_workers in self.workers.items():
+            for _ in range(num_workers):
+                # None is the stop signal. It sorts after every real job so the queue is drained first
+                self.queues[kind].put((1, 0, next(Job._sequence), None))
+
+        if wait_for_jobs:
+            for thread in self.threads:
+                thread.join()
+
+        if self.process_pool:
+            self.process_pool.shutdown(wait=wait_for_jobs)
+
+    def increment(self, counter: str, amount: int = 1) -> int:
+        """Thread-safe counter. Returns the new value"""
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+            return self.counters[counter]
+
+    @staticmethod
+    def wait(futures: Iterable[Future]) -> None:
+        """Block until every future is done"""
+        wait(list(futures))
+
+    def _worker(self, kind: str) -> None:
+        queue: PriorityQueue = self.queues[kind]
+
+        while True:
+            *_, job = queue.get()
+
+            if job is None:
+                break
+
+            if not job.future.set_running_or_notify_cancel():
+                continue  # cancelled while it was still queued
+
+            try:
+                if job.gate and not job.gate():
+                    raise JobSkipped(f'{job} was skipped by its gate')
+
+                if kind == 'cpu' and self.process_pool:
+                    result: Any = self.process_pool.submit(job.func, *job.args).result()
+                else:
+                    result: Any = job.func(*job.args)
+            except BaseException as error:
+                self.increment(f'{kind}_failed')
+                job.future.set_exception(error)
+            else:
+                self.increment(f'{kind}_finished')
+                with self.lock:
+                    self.results.append((job, result))
+                job.future.set_result(result)
+
+
+class SpaceLedger:
+    """
+    Running count of free space on the backup disk while deletes and archives run at the same time. Every pending
+    delete is announced with expect() and counted with credit() once it is done. An archive calls reserve() before it
+    starts writing, which waits until enough deletes have finished to make room for it. Once close() has been called
+    no more deletes are coming, and a reservation that still does not fit gives up instead of waiting forever.
+    """
+
+    def __init__(self, available: int, margin: int = 0):
+        self.available: int = available - margin  # bytes that can still be handed out
+        self.pending: int = 0                     # bytes of deletes that have been scheduled but have not finished
+        self.closed: bool = False
+        self.condition: Condition = Condition()
+
+    def expect(self, size: int) -> None:
+        """A delete of size bytes has been scheduled"""
+        with self.condition:
+            self.pending += size
+
+    def credit(self, size: int, success: bool = True) -> None:
+        """A delete scheduled with expect() has finished (or failed)"""
+        with self.condition:
+            self.pending -= size
+            if success:
+                self.available += size
+            self.condition.notify_all()
+
+    def close(self) -> None:
+        """No more deletes will be scheduled"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def reserve(self, size: int) -> bool:
+        """Wait for size bytes to be free and take them. Returns False if they never can be."""
+        with self.condition:
+            while self.available < size:
+                if self.closed and self.pending <= 0:
+                    return False
+                self.condition.wait()
+
+            self.available -= size
+            return True
+
+    def release(self, size: int) -> None:
+        """Give back a reservation, e.g. when the job that made it failed"""
+        with self.condition:
+            self.available += size
+            self.condition.notify_all()
@@ -0,0 +1,168 @@
+from os import stat, major, minor
+from os.path import realpath
+from threading import Condition, Thread, Lock
+from time import monotonic, sleep
+from contextlib import contextmanager
+from typing import Iterator, Iterable
+
+
+class TokenBucket:
+    """
+    Bandwidth cap shared by every thread that takes from it. Tokens are bytes and refill at rate per second, up to
+    burst. A request bigger than what is in the bucket drives it into debt, and the caller sleeps the debt off, so
+    large requests are paced correctly without being split up.
+    """
+
+    def __init__(self, rate: int, burst: int | None = None):
+        self.rate: int = rate
+        self.burst: int = burst or rate  # one second of traffic by default
+        self.tokens: float = self.burst
+        self.updated: float = monotonic()
+        self.lock: Lock = Lock()
+
+    def consume(self, nbytes: int) -> None:
+        if self.rate <= 0:
+            return
+
+        with self.lock:
+            now: float = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= nbytes
+            debt: float = -self.tokens
+
+        if debt > 0:
+            sleep(debt / self.rate)
+
+
+class DiskLatency:
+    """Average time per completed request on some block devices, from the counters in /proc/diskstats"""
+
+    def __init__(self, devices: Iterable[tuple[int, int]]):
+        self.devices: set[tuple[int, int]] = set(devices)  # (major, minor)
+        self.last: dict[tuple[int, int], tuple[int, int]] = self._read()
+
+    def sample(self) -> float:
+        """Milliseconds per request since the last sample, on the slowest device. 0 if no device did any I/O."""
+        current: dict[tuple[int, int], tuple[int, int]] = self._read()
+        latency: float = 0.0
+
+        for device, (requests, milliseconds) in current.items():
+            last_requests, last_milliseconds = self.last.get(device, (requests, milliseconds))
+
+            if requests > last_requests:
+                latency = max(latency, (milliseconds - last_milliseconds) / (requests - last_requests))
+
+        self.last = current
+        return latency
+
+    def _read(self) -> dict[tuple[int, int], tuple[int, int]]:
+        """(major, minor): (reads + writes completed, milliseconds spent reading + writing)"""
+        counters: dict[tuple[int, int], tuple[int, int]] = {}
+
+        with open('/proc/diskstats', 'r') as fh:
+            for line in fh:
+                fields: list[str] = line.split()
+                device: tuple[int, int] = (int(fields[0]), int(fields[1]))
+
+                if device in self.devices:
+                    counters[device] = (int(fields[3]) + int(fields[7]), int(fields[6]) + int(fields[10]))
+
+        return counters
+
+
+def devices_of(paths: Iterable[str]) -> set[tuple[int, int]]:
+    """Block devices (major, minor) that hold the given paths. Symlinks are followed to where the data really is."""
+    devices: set[tuple[int, int]] = set()
+
+    for path in paths:
+        try:
+            device: int = stat(realpath(path)).st_dev
+        except FileNotFoundError:
+            continue
+        devices.add((major(device), minor(device)))
+
+    return devices
+
+
+class Throttle:
+    """
+    Keeps background jobs from starving ZoneMinder of disk time. Every unit of work (a file copied, a block archived,
+    a batch of files deleted) goes through io(), which holds one of a limited number of slots while it runs and pays
+    its bytes to an optional TokenBucket.
+
+    With a target latency the number of slots adapts. A thread samples the latency of the watched devices every
+    interval seconds, halves the slots when the disks are slower than the target, and adds one back when they are well
+    under it. The thread is only started by the first io() call.
+    """
+
+    def __init__(self, bandwidth: int = 0, max_slots: int = 16, min_slots: int = 1, target_latency_ms: float = 0,
+                 devices: Iterable[tuple[int, int]] = (), interval: float = 1.0):
+        self.bucket: TokenBucket = TokenBucket(bandwidth)
+        self.max_slots: int = max_slots
+        self.min_slots: int = min_slots
+        self.target_latency_ms: float = target_latency_ms
+        self.devices: set[tuple[int, int]] = set(devices)
+        self.interval: float = interval
+        self.limit: int = max_slots     # slots that may be held right now
+        self.active: int = 0            # slots held right now
+        self.latency_ms: float = 0.0    # last sample
+        self.lowest_limit: int = max_slots
+        self.condition: Condition = Condition()
+        self.controller: Thread | None = None
+
+    @property
+    def adaptive(self) -> bool:
+        return self.target_latency_ms > 0 and bool(self.devices)
+
+    @contextmanager
+    def io(self, nbytes: int = 0) -> Iterator[None]:
+        """Hold a slot for the body of the with block, after paying nbytes of bandwidth"""
+        if not self.adaptive:
+            self.bucket.consume(nbytes)
+            yield
+            return
+
+        self._start_controller()
+
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+        try:
+            self.bucket.consume(nbytes)
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify()
+
+    def adjust(self, latency_ms: float) -> int:
+        """Change the slot limit for one latency sample. Returns the new limit."""
+        with self.condition:
+            self.latency_ms = latency_ms
+
+            if latency_ms > self.target_latency_ms:
+                self.limit = max(self.min_slots, self.limit // 2)
+            elif latency_ms < self.target_latency_ms / 2:
+                self.limit = min(self.max_slots, self.limit + 1)
+                self.condition.notify_all()
+
+            self.lowest_limit = min(self.lowest_limit, self.limit)
+            return self.limit
+
+    def _start_controller(self) -> None:
+        with self.condition:
+            if self.controller:
+                return
+
+            self.controller = Thread(target=self._control, name='throttle', daemon=True)
+            self.controller.start()
+
+    def _control(self) -> None:
+        latency: DiskLatency = DiskLatency(self.devices)
+
+        while True:
+            sleep(self.interval)
+            self.adjust(latency.sample())
@@ -0,0 +1,186 @@
+import errno
+from os import rename, makedirs, scandir, stat, symlink, readlink, unlink, sendfile, cpu_count
+from os.path import dirname, join, lexists, relpath
+from shutil import copystat, copyfileobj
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from zm_throttle import Throttle
+from zm_manifest import file_digest, write_manifest, tree_manifest_name
+
+try:
+    from os import copy_file_range  # Linux only, python 3.8+
+except ImportError:
+    copy_file_range = None
+
+
+# The kernel says one of these when copy_file_range() or sendfile() can not be used between two files
+_fallback_errors: set[int] = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF, errno.ETXTBSY}
+_chunk_size: int = 1024 ** 3  # bytes asked for per copy_file_range()/sendfile() call
+
+
+def same_filesystem(path_a: str, path_b: str) -> bool:
+    """True if both paths (which must exist) are on the same device, so one can be renamed to the other"""
+    return stat(path_a).st_dev == stat(path_b).st_dev
+
+
+def move_tree(source: str, destination: str, workers: int | None = None, compare: str = 'stat',
+              throttle: Throttle | None = None, manifest: bool = False) -> str:
+    """
+    Move a directory tree. If the destination does not exist yet and is on the same filesystem, this is a single
+    rename(). Otherwise the tree is copied with copy_tree() and the source is left for the caller to delete. Returns
+    'renamed' or 'copied'.
+    """
+    makedirs(dirname(destination), exist_ok=True)
+
+    try:
+        if same_filesystem(source, dirname(destination)):
+            rename(source, destination)
+            return 'renamed'
+    except OSError as error:
+        if error.errno not in (errno.EXDEV, errno.ENOTEMPTY, errno.EEXIST):
+            raise
+
+    copy_tree(source, destination, workers=workers, compare=compare, throttle=throttle, manifest=manifest)
+    return 'copied'
+
+
+def copy_tree(source: str, destination: str, workers: int | None = None, compare: str = 'stat',
+              throttle: Throttle | None = None, manifest: bool = False) -> int:
+    """
+    Copy a directory tree like shutil.copytree(symlinks=True, dirs_exist_ok=True), but copy the files on a thread
+    pool and move the bytes inside the kernel. ZoneMinder days are hundreds of thousands of small frames, so per-file
+    overhead matters more than throughput.
+
+    Files already in the destination are skipped if they match, so a copy that was interrupted picks up where it
+    stopped. compare is 'stat' (same size and mtime), 'checksum' (same size and sha256) or 'none' (copy everything).
+    A throttle paces the copies, one file at a time.
+
+    With manifest=True every file of the source is hashed from the destination once it is there, and the hashes are
+    written to a manifest in the destination for zm_manifest.verify_tree(). Returns the number of files copied.
+    """
+    if compare not in ('stat', 'checksum', 'none'):
+        raise ValueError(f'Unknown compare mode {compare}. Use stat, checksum or none.')
+
+    directories: list[tuple[str, str]] = []  # (source, destination). Their stats are copied once the files are in
+    files: list[tuple[str, str]] = []
+    stack: list[tuple[str, str]] = [(source, destination)]
+
+    while stack:
+        source_dir, destination_dir = stack.pop()
+        makedirs(destination_dir, exist_ok=True)
+        directories.append((source_dir, destination_dir))
+
+        with scandir(source_dir) as entries:
+            for entry in entries:
+                target: str = join(destination_dir, entry.name)
+
+                if entry.is_symlink():
+                    if lexists(target):
+                        unlink(target)  # replacing an earlier copy
+                    symlink(readlink(entry.path), target)
+                elif entry.is_dir():
+                    stack.append((entry.path, target))
+                else:
+                    files.append((entry.path, target))
+
+    with ThreadPoolExecutor(max_workers=workers or min(32, (cpu_count() or 1) * 4)) as pool:
+        # list() so the first error is raised here
+        results: list[tuple[bool, tuple[int, str] | None]] = list(pool.map(
+            lambda pair: sync_file(*pair, compare=compare, throttle=throttle, digest=manifest), files
+        ))
+
+    for source_dir, destination_dir in reversed(directories):
+        copystat(source_dir, destination_dir)
+
+    if manifest:
+        write_manifest(join(destination, tree_manifest_name), {
+            'source': source,
+            'files': {relpath(target, destination): digest for (_, target), (_, digest) in zip(files, results)},
+        })
+
+    return sum(copied for copied, _ in results)
+
+
+def sync_file(source: str, destination: str, compare: str = 'stat', throttle: Throttle | None = None,
+              digest: bool = False) -> tuple[bool, tuple[int, str] | None]:
+    """
+    Copy a file unless the destination already matches it. Returns whether it was copied, and with digest=True the
+    (size, sha256) of the destination. The copy itself stays in the kernel; the destination is read back afterwards,
+    while it is most likely still in the page cache, and must have the size of the source.
+    """
+    copied: bool = compare == 'none' or not is_unchanged(source, destination, checksum=compare == 'checksum')
+
+    if copied:
+        with throttle.io(stat(source).st_size) if throttle else nullcontext():
+            copy_file(source, destination)
+
+    if not digest:
+        return copied, None
+
+    destination_digest: tuple[int, str] = file_digest(destination)
+    source_size: int = stat(source).st_size
+
+    if destination_digest[0] != source_size:
+        raise OSError(f'{destination} has {destination_digest[0]} bytes after copying, {source} has {source_size}')
+
+    return copied, destination_digest
+
+
+def is_unchanged(source: str, destination: str, checksum: bool = False) -> bool:
+    """
+    True if the destination has the same size as the source and the same mtime (to the second, since some backup
+    filesystems do not keep more), or the same sha256 with checksum=True. A partly copied file never gets the mtime
+    of its source, because copy_file() sets it last.
+    """
+    try:
+        destination_stat = stat(destination)
+    except FileNotFoundError:
+        return False
+
+    source_stat = stat(source)
+
+    if source_stat.st_size != destination_stat.st_size:
+        return False
+
+    if checksum:
+        return file_digest(source) == file_digest(destination)
+
+    return int(source_stat.st_mtime) == int(destination_stat.st_mtime)
+
+
+def copy_file(source: str, destination: str) -> None:
+    """
+    Copy one file with its permissions and times. copy_file_range() lets the kernel (or the filesystem, with reflinks
+    or server side copies) move the data without it passing through python. sendfile() and a plain buffered copy are
+    the fallbacks.
+    """
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        if not _kernel_copy(src.fileno(), dst.fileno()):
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+            copyfileobj(src, dst, 1024 ** 2)
+
+    copystat(source, destination)
+
+
+def _kernel_copy(source_fd: int, destination_fd: int) -> bool:
+    """Copy everything from one fd to the other inside the kernel. False if neither syscall works for these files."""
+    for syscall in (copy_file_range, sendfile):
+        if syscall is None:
+            continue
+
+        try:
+            while True:
+                if syscall is sendfile:
+                    copied: int = sendfile(destination_fd, source_fd, None, _chunk_size)
+                else:
+                    copied: int = copy_file_range(source_fd, destination_fd, _chunk_size)
+
+                if copied == 0:
+                    return True
+        except OSError as error:
+            if error.errno not in _fallback_errors:
+                raise
+
+    return False
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+# Verify the backups on the backup disk against the manifests written with them. The backup disk has to be mounted.
+#
+# Every archive has a .manifest.json beside it with its own sha256 and the sha256 of every file put into it, and every
+# copied directory has a .zm_manifest.json inside it. zm_move.py already checks each backup before deleting its
+# source (see verify_backups in zm_lib.py). This is for checking them again later, e.g. from a monthly cron job.
+#
+#   $ zm_verify.py                      # everything under save_dir, archives re-read and compared
+#   $ zm_verify.py --deep               # also decompress every archive and compare every file
+#   $ zm_verify.py PATH [PATH ...]      # only these archives or directories
+#
+# Backups are verified restore_workers at a time, and an indexed archive is decompressed one event per core. Exits
+# with 1 if anything did not match.
+import sys
+import argparse
+from os import walk
+from os.path import isdir, join
+from datetime import datetime as dt
+from concurrent.futures import ThreadPoolExecutor, Future
+from zm_archive import verify_archive, archive_errors
+from zm_manifest import verify_tree, tree_manifest_name
+from zm_lib import save_dir, logger, restore_workers
+
+
+def find_backups(paths: list[str]) -> list[tuple[str, str]]:
+    """Backups with a manifest under the given paths. Returns [('archive' or 'tree', path)]."""
+    backups: list[tuple[str, str]] = []
+    archive_suffix: str = '.manifest.json'
+
+    for path in paths:
+        if not isdir(path):
+            backups.append(('archive', path))
+            continue
+
+        for directory, _, names in walk(path):
+            if tree_manifest_name in names:
+                backups.append(('tree', directory))
+
+            backups += [
+                ('archive', join(directory, name[:-len(archive_suffix)])) for name in names
+                if name.endswith(archive_suffix)
+            ]
+
+    return backups
+
+
+parser: argparse.ArgumentParser = argparse.ArgumentParser(description='Verify backups against their manifests')
+parser.add_argument('paths', nargs='*', default=[save_dir], help=f'archives or directories (default {save_dir})')
+parser.add_argument('--deep', action='store_true', help='decompress archives and compare every file')
+parser.add_argument('--workers', type=int, default=restore_workers, help='backups to verify at once')
+parser.add_argument('--uncached', action='store_true', help='drop each file from the page cache before reading it')
+args: argparse.Namespace = parser.parse_args()
+
+backups: list[tuple[str, str]] = find_backups(args.paths)
+logger.warning(f'Verifying {len(backups)} backups{" (deep)" if args.deep else ""}')
+started: dt = dt.now()
+num_failed: int = 0
+
+with ThreadPoolExecutor(max_workers=args.workers) as pool:
+    futures: list[tuple[str, Future]] = [
+        (path, pool.submit(verify_tree, path, None, args.uncached) if kind == 'tree' else
+         pool.submit(verify_archive, path, args.deep, None, args.uncached))
+        for kind, path in backups
+    ]
+
+    for path, future in futures:
+        try:
+            problems: list[str] = future.result()
+        except archive_errors as e:  # one unreadable backup is reported like any other that does not match
+            problems = [f'{path}: {e!r}']
+
+        if problems:
+            num_failed += 1
+            for problem in problems:
+                logger.error(problem)
+        else:
+            logger.debug(f'Verified {path}')
+
+logger.warning(f'Verified {len(backups)} backups in {dt.now() - started}. {num_failed} failed.')
+sys.exit(1 if num_failed else 0)